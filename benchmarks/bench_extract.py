@@ -0,0 +1,99 @@
+"""
+Micro-benchmark of emote extraction from message contents.
+Compares the previous implementation (findall + two re.search calls per emote and list based de-duplication)
+against EmoteTracker.get_message_emotes.
+
+Usage: python benchmarks/bench_extract.py [number of passes]
+"""
+from types import SimpleNamespace
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from emote_track import EmoteTracker
+
+
+GUILD_EMOTES = {700000000000000000 + i: f"emote{i}" for i in range(250)}
+FOREIGN_EMOTES = {800000000000000000 + i: f"nitro{i}" for i in range(50)}
+
+
+def legacy_get_message_emotes(message, duplicates: bool = False) -> list:
+    proccessed_ids = []
+    emotes = []
+    guild_emotes_snowflakes = [x.id for x in message.guild.emojis]
+    for emote in re.findall(r"<:\w*:\d*>", message.content):
+        id = int(re.search(r"(?<=:)\d.*(?=>)",emote).group(0))
+        if (duplicates or id not in proccessed_ids) and id in guild_emotes_snowflakes:
+            emotes.append(
+                {
+                    "name" : re.search(r"(?<=<:).*(?=:)", emote).group(0),
+                    "snowflake" : id
+                }
+            )
+            proccessed_ids.append(id)
+
+    return emotes
+
+
+def make_corpus(size: int):
+    """
+    Generates message contents with roughly the mix seen on a chatty server:
+    mostly plain text, some mentions and links, and messages with one or more (animated) emotes.
+    """
+    rnd = random.Random(0)
+    words = "the a lol what ok yes no maybe tomorrow game play nice gg wp xd why how".split()
+    emotes = list(GUILD_EMOTES.items()) + list(FOREIGN_EMOTES.items())
+
+    def emote():
+        snowflake, name = rnd.choice(emotes)
+        return f"<{'a' if rnd.random() < 0.2 else ''}:{name}:{snowflake}>"
+
+    corpus = []
+    for _ in range(size):
+        text = " ".join(rnd.choices(words, k=rnd.randint(1, 25)))
+        kind = rnd.random()
+        if kind < 0.55:
+            pass
+        elif kind < 0.65:
+            text = f"<@{rnd.randint(10**17, 10**18)}> {text}"
+        elif kind < 0.70:
+            text = f"{text} https://example.com/{rnd.randint(0, 10**6)}"
+        elif kind < 0.90:
+            text = f"{text} {emote()}"
+        else:
+            text = " ".join([text] + [emote() for _ in range(rnd.randint(2, 8))])
+
+        corpus.append(text)
+
+    return corpus
+
+
+def main():
+    passes = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    guild = SimpleNamespace(id=1, emojis=tuple(SimpleNamespace(id=id, name=name) for id, name in GUILD_EMOTES.items()))
+    messages = [SimpleNamespace(content=content, guild=guild) for content in make_corpus(5000)]
+    tracker = EmoteTracker(30, None, None)
+    tracker.index_guild(guild)
+
+    def run_legacy():
+        for message in messages:
+            legacy_get_message_emotes(message)
+
+    def run_new():
+        for message in messages:
+            tracker.get_message_emotes(message)
+
+    legacy = min(timeit.repeat(run_legacy, number=1, repeat=passes))
+    new = min(timeit.repeat(run_new, number=1, repeat=passes))
+    print(f"{len(messages)} messages, best of {passes} passes")
+    print(f"legacy:              {legacy*1000:8.2f} ms ({legacy/len(messages)*1e6:6.2f} us/message)")
+    print(f"get_message_emotes:  {new*1000:8.2f} ms ({new/len(messages)*1e6:6.2f} us/message)")
+    print(f"speedup:             {legacy/new:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Benchmark of the SQLite pragma profiles with concurrent readers and writers.
+A writer thread writes small batches of emote logs as fast as it can (like the batch writer under load),
+while reader threads run uncached statistics queries.
+Reports the insert throughput and read latency percentiles for each profile.
+
+Usage: python benchmarks/bench_sqlite.py [seconds per profile] [reader threads]
+"""
+from types import SimpleNamespace
+import datetime as dt
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import sql
+
+
+GUILDS = 20
+EMOTES = 100
+BATCH = 20
+
+
+def populate(manager: sql.Manager):
+    """
+    Fills the database with 30 days of history.
+    """
+    today = dt.date.today()
+    for guild in range(GUILDS):
+        manager.write_batch({
+            (guild, guild * 1000 + emote, today - dt.timedelta(days=day)): sql.BatchEntry(f"guild{guild}", f"emote{emote}", random.randint(1, 50))
+            for emote in range(EMOTES) for day in range(30)
+        })
+
+
+def run(profile: str, duration: float, readers: int):
+    with tempfile.TemporaryDirectory() as directory:
+        manager = sql.Manager(os.path.join(directory, "bench.db"), profile=profile, cache_size=0)
+        manager.connect()
+        populate(manager)
+
+        stop = threading.Event()
+        inserts = 0
+        latencies = []
+
+        def writer():
+            nonlocal inserts
+            rnd = random.Random(0)
+            while not stop.is_set():
+                guild = SimpleNamespace(id=rnd.randrange(GUILDS), name="guild")
+                batch = {}
+                for _ in range(BATCH):
+                    emote = rnd.randrange(EMOTES)
+                    manager.aggregate(batch, guild.id, guild.name, dt.date.today(), [{"name": f"emote{emote}", "snowflake": guild.id * 1000 + emote}])
+
+                manager.write_batch(batch)
+                inserts += BATCH
+
+        def reader(seed: int):
+            rnd = random.Random(seed)
+            while not stop.is_set():
+                start = time.perf_counter()
+                manager.statistics(rnd.randrange(GUILDS), 40, 30)
+                latencies.append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader, args=(n,)) for n in range(readers)]
+        for thread in threads:
+            thread.start()
+
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        manager.engine.dispose()
+        if manager.read_engine is not None:
+            manager.read_engine.dispose()
+
+    latencies.sort()
+    percentile = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+    print(
+        f"{profile:12s} inserts/s: {inserts / duration:9.0f}   reads/s: {len(latencies) / duration:7.0f}   "
+        f"read p50: {percentile(0.5):7.2f} ms   p99: {percentile(0.99):7.2f} ms   mean: {statistics.fmean(latencies) * 1000:7.2f} ms"
+    )
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    print(f"{GUILDS} guilds, {EMOTES} emotes each, {BATCH} logs per write transaction, {readers} reader threads, {duration} s per profile")
+    for profile in sql.PROFILES:
+        run(profile, duration, readers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Tuple
+import asyncio
+import threading
+import time
+
+
+class ReactionCache:
+    """
+    Bounded LRU set of recently seen reactions, used to avoid counting the same reaction more than once.
+    Membership checks, insertions and evictions are all O(1).
+
+    Parameters
+    ----------
+    - max_size: `int`   - Maximum number of remembered reactions (across all users).
+    - ttl:      `float` - Number of seconds after the last use a reaction is forgotten (None to only evict on size).
+    """
+    def __init__(self, max_size: int = 50000, ttl: float = None) -> None:
+        self.max_size: int = max_size
+        self.ttl: float = ttl
+        self.entries: OrderedDict = OrderedDict() #: Keys are the reactions, values timestamps of last use (oldest first).
+        self.hits: int = 0 #: Number of reactions that were already in the cache.
+        self.misses: int = 0 #: Number of reactions that were not in the cache.
+        self.evictions: int = 0 #: Number of reactions removed due to size or ttl.
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        stamp = self.entries.get(key)
+        return stamp is not None and (self.ttl is None or time.monotonic() - stamp < self.ttl)
+
+    def add(self, key: Hashable) -> bool:
+        """
+        Remembers the reaction.
+
+        Parameters
+        ----------
+        - key: `Hashable` - The reaction key, eg. (user_snowflake, message_snowflake, emote_snowflake).
+
+        Returns
+        ----------
+        `True` if the reaction was not yet in the cache, `False` if it's a duplicate.
+        """
+        now = time.monotonic()
+        entries = self.entries
+        new = key not in self
+        if new:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        entries[key] = now
+        entries.move_to_end(key)
+        self.expire(now)
+        return new
+
+    def expire(self, now: float = None):
+        """
+        Evicts the least recently used reactions that are over the size limit or older than ttl.
+
+        Parameters
+        ----------
+        - now: `float` - The current time.monotonic() timestamp.
+        """
+        entries = self.entries
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+        if self.ttl is not None and entries:
+            if now is None:
+                now = time.monotonic()
+
+            for key, stamp in entries.items():
+                if now - stamp < self.ttl:
+                    break
+            else:
+                key = None
+
+            # Entries are ordered by timestamp, all before the first non-expired one are expired.
+            while entries and next(iter(entries)) != key:
+                entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the cache counters.
+        """
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+class StatisticsCache:
+    """
+    Bounded LRU cache of statistics results with per-guild invalidation.
+    Invalidating a guild is O(1), it only increases the guild's write generation,
+    entries cached under an older generation are treated as stale.
+    Can be used from multiple threads.
+
+    Parameters
+    ----------
+    - max_size:  `int`   - Maximum number of cached results.
+    - staleness: `float` - Number of seconds a result may still be returned after the guild was written to.
+    """
+    def __init__(self, max_size: int = 256, staleness: float = 0) -> None:
+        self.max_size: int = max_size
+        self.staleness: float = staleness
+        self.entries: OrderedDict = OrderedDict() #: Keys are (guild_snowflake, *arguments), values (result, timestamp, generation).
+        self.generations: Dict[int, int] = {} #: Keys are guild snowflakes, values number of writes to the guild.
+        self.lock = threading.Lock()
+        self.hits: int = 0 #: Number of results returned from the cache.
+        self.misses: int = 0 #: Number of results that were not cached or were stale.
+        self.evictions: int = 0 #: Number of results removed due to size.
+
+    def get(self, key: Tuple) -> Any:
+        """
+        Returns the cached result or None if it's not cached or is stale.
+
+        Parameters
+        ----------
+        - key: `Tuple` - The statistics arguments, starting with the guild snowflake.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                result, stamp, generation = entry
+                if generation == self.generations.get(key[0], 0) or time.monotonic() - stamp <= self.staleness:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return result
+
+                del self.entries[key]
+
+            self.misses += 1
+            return None
+
+    def generation(self, guild_snowflake: int) -> int:
+        """
+        Returns the guild's write generation.
+
+        Parameters
+        ----------
+        - guild_snowflake: `int` - Snowflake of the guild.
+        """
+        with self.lock:
+            return self.generations.get(guild_snowflake, 0)
+
+    def put(self, key: Tuple, result: Any, generation: int = None):
+        """
+        Caches the result.
+
+        Parameters
+        ----------
+        - key:        `Tuple` - The statistics arguments, starting with the guild snowflake.
+        - result:     `Any`   - The statistics result.
+        - generation: `int`   - The guild's write generation from before the result was read (defaults to the current one).
+        """
+        with self.lock:
+            if generation is None:
+                generation = self.generations.get(key[0], 0)
+
+            self.entries[key] = (result, time.monotonic(), generation)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, guild_snowflake: int):
+        """
+        Marks all the cached results of the guild as stale.
+
+        Parameters
+        ----------
+        - guild_snowflake: `int` - Snowflake of the guild that was written to.
+        """
+        with self.lock:
+            self.generations[guild_snowflake] = self.generations.get(guild_snowflake, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the cache counters.
+        """
+        requests = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / requests if requests else 0
+        }
+
+
+class IdentityCache:
+    """
+    Cache of database row ids of servers and emotes, used for resolving emotes without lookup queries.
+    Emotes are resolved by snowflake first and then by name, the same way the database resolves them
+    (an emote with the same name replaces the old one).
+    Not thread safe, must only be used from the database thread.
+    """
+    def __init__(self) -> None:
+        self.servers: Dict[int, Tuple[int, str]] = {} #: Keys are server snowflakes, values (row id, name).
+        self.snowflakes: Dict[Tuple[int, int], int] = {} #: Keys are (server row id, emote snowflake), values emote row ids.
+        self.names: Dict[Tuple[int, str], int] = {} #: Keys are (server row id, emote name), values emote row ids.
+        self.emotes: Dict[int, Tuple[int, int, str]] = {} #: Keys are emote row ids, values (server row id, snowflake, name).
+
+    def clear(self):
+        """
+        Removes everything from the cache (eg. after a failed transaction).
+        """
+        self.servers.clear()
+        self.snowflakes.clear()
+        self.names.clear()
+        self.emotes.clear()
+
+    def server(self, snowflake: int) -> Tuple[int, str]:
+        """
+        Returns (row id, name) of the server or None if it's not cached.
+
+        Parameters
+        ----------
+        - snowflake: `int` - Snowflake of the server.
+        """
+        return self.servers.get(snowflake)
+
+    def set_server(self, snowflake: int, server_id: int, name: str):
+        """
+        Caches the server.
+
+        Parameters
+        ----------
+        - snowflake: `int` - Snowflake of the server.
+        - server_id: `int` - Row id of the server.
+        - name:      `str` - Name of the server.
+        """
+        self.servers[snowflake] = (server_id, name)
+
+    def emote(self, server_id: int, snowflake: int, name: str) -> int:
+        """
+        Returns the row id of the emote (matched by snowflake or name) or None if it's not cached.
+
+        Parameters
+        ----------
+        - server_id: `int` - Row id of the server.
+        - snowflake: `int` - Snowflake of the emote.
+        - name:      `str` - Name of the emote.
+        """
+        emote_id = self.snowflakes.get((server_id, snowflake))
+        if emote_id is None:
+            emote_id = self.names.get((server_id, name))
+
+        return emote_id
+
+    def identity(self, emote_id: int) -> Tuple[int, int, str]:
+        """
+        Returns (server row id, snowflake, name) of the cached emote.
+
+        Parameters
+        ----------
+        - emote_id: `int` - Row id of the emote.
+        """
+        return self.emotes.get(emote_id)
+
+    def set_emote(self, server_id: int, emote_id: int, snowflake: int, name: str):
+        """
+        Caches the emote, replacing it's old snowflake and name.
+
+        Parameters
+        ----------
+        - server_id: `int` - Row id of the server.
+        - emote_id:  `int` - Row id of the emote.
+        - snowflake: `int` - Snowflake of the emote.
+        - name:      `str` - Name of the emote.
+        """
+        old = self.emotes.get(emote_id)
+        if old is not None:
+            _, old_snowflake, old_name = old
+            if self.snowflakes.get((server_id, old_snowflake)) == emote_id:
+                del self.snowflakes[(server_id, old_snowflake)]
+
+            if self.names.get((server_id, old_name)) == emote_id:
+                del self.names[(server_id, old_name)]
+
+        self.emotes[emote_id] = (server_id, snowflake, name)
+        self.snowflakes[(server_id, snowflake)] = emote_id
+        self.names[(server_id, name)] = emote_id
+
+
+class Leaderboard:
+    """
+    Periodically recomputed leaderboard (eg. the global statistics), so reading it never queries the database.
+    The computation runs in the background every refresh seconds, the previous result is served meanwhile.
+
+    Parameters
+    ----------
+    - compute: `Callable[[], Awaitable[List[Tuple]]]` - Coroutine function that computes the leaderboard.
+    - refresh: `float` - Number of seconds between two computations.
+    """
+    def __init__(self, compute: Callable[[], Awaitable[List[Tuple]]], refresh: float) -> None:
+        self.compute = compute
+        self.refresh: float = refresh
+        self.result: List[Tuple] = []
+        self.updated: float = None #: Timestamp of the last computation (None if not yet computed).
+
+    async def run(self):
+        """
+        Recomputes the leaderboard every refresh seconds.
+        """
+        while True:
+            try:
+                self.result = await self.compute()
+                self.updated = time.time()
+            except Exception as ex:
+                print(f"Failed to compute the leaderboard: {ex}")
+
+            await asyncio.sleep(self.refresh)
+
+    def top(self, limit: int) -> List[Tuple]:
+        """
+        Returns the first limit rows of the last computed leaderboard.
+
+        Parameters
+        ----------
+        - limit: `int` - Number of rows to return.
+        """
+        return self.result[:limit]
+
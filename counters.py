@@ -0,0 +1,508 @@
+from array import array
+from typing import Callable, Dict, List, Tuple
+import datetime as dt
+import heapq
+
+
+HOURS_OF_WEEK = 7 * 24
+
+
+def hour_of_week(moment: dt.datetime) -> int:
+    """
+    Returns the hour of the week (0 is Monday 00:00 - 00:59) of the moment.
+    """
+    return moment.weekday() * 24 + moment.hour
+
+
+def unpack_heatmap(data: bytes = None) -> array:
+    """
+    Returns the array of HOURS_OF_WEEK unsigned 32 bit counts packed inside data (all zero if data is None).
+    """
+    heatmap = array("I")
+    heatmap.frombytes(data if data is not None else bytes(4 * HOURS_OF_WEEK))
+    return heatmap
+
+
+class DayRing:
+    """
+    Fixed-size ring of daily counts, the slot of a day is it's ordinal % size.
+    Slots of days that are skipped are zeroed when the ring advances, so the ring always holds
+    the counts of last size days up to (and including) day.
+
+    Parameters
+    ----------
+    - size:  `int`   - Number of days in the ring.
+    - day:   `int`   - Ordinal of the newest day in the ring.
+    - slots: `array` - Daily counts (all zero if not given).
+    """
+    __slots__ = ("size", "day", "slots", "total")
+
+    def __init__(self, size: int, day: int, slots: array = None) -> None:
+        self.size: int = size
+        self.day: int = day #: Ordinal of the newest day in the ring.
+        self.slots: array = array("I", bytes(4 * size)) if slots is None else slots
+        self.total: int = sum(self.slots) #: Sum of all the slots.
+
+    @classmethod
+    def from_bytes(cls, size: int, day: int, data: bytes) -> "DayRing":
+        slots = array("I")
+        slots.frombytes(data)
+        return cls(size, day, slots)
+
+    def to_bytes(self) -> bytes:
+        return self.slots.tobytes()
+
+    def advance(self, day: int):
+        """
+        Moves the ring forward to the day, zeroing the slots of skipped days.
+
+        Parameters
+        ----------
+        - day: `int` - Ordinal of the new newest day.
+        """
+        if day <= self.day:
+            return
+
+        if day - self.day >= self.size:
+            self.slots = array("I", bytes(4 * self.size))
+            self.total = 0
+        else:
+            slots = self.slots
+            for skipped in range(self.day + 1, day + 1):
+                index = skipped % self.size
+                self.total -= slots[index]
+                slots[index] = 0
+
+        self.day = day
+
+    def add(self, day: int, count: int) -> bool:
+        """
+        Increases the count of the day, advancing the ring if needed.
+
+        Parameters
+        ----------
+        - day:   `int` - Ordinal of the day.
+        - count: `int` - The amount to add.
+
+        Returns
+        ----------
+        `False` if the day is too old to be in the ring, `True` otherwise.
+        """
+        self.advance(day)
+        if day <= self.day - self.size:
+            return False
+
+        self.slots[day % self.size] += count
+        self.total += count
+        return True
+
+    def window(self, day_limit: int, today: int) -> int:
+        """
+        Returns the sum of counts in last day_limit days up to (and including) today.
+
+        Parameters
+        ----------
+        - day_limit: `int` - Number of days to sum.
+        - today:     `int` - Ordinal of the current day.
+        """
+        self.advance(today)
+        first = max(today - day_limit, self.day - self.size) + 1
+        last = min(self.day, today)
+        if first <= self.day - self.size + 1 and last == self.day:
+            return self.total
+
+        return sum(self.slots[day % self.size] for day in range(first, last + 1))
+
+
+class EmoteCounter:
+    """
+    In-memory counters of a single emote.
+
+    Parameters
+    ----------
+    - name:  `str`     - Name of the emote.
+    - total: `int`     - All time count.
+    - ring:  `DayRing` - Daily counts.
+    """
+    __slots__ = ("name", "total", "ring")
+
+    def __init__(self, name: str, total: int, ring: DayRing) -> None:
+        self.name = name
+        self.total = total
+        self.ring = ring
+
+
+class GuildEmotes:
+    """
+    In-memory per-guild entries of emotes (objects with a name attribute).
+    Like the database, emotes with the same name replace each other:
+    a new emote takes over the entry of the emote with it's name and a renamed emote keeps it's entry.
+    """
+    def __init__(self) -> None:
+        self.guilds: Dict[int, Dict[int, object]] = {}
+        "Keys are guild snowflakes, values dictionaries of emote snowflake to it's entry."
+        self.names: Dict[int, Dict[str, int]] = {}
+        "Keys are guild snowflakes, values dictionaries of emote name to emote snowflake."
+
+    def clear(self):
+        """
+        Removes all the entries.
+        """
+        self.guilds.clear()
+        self.names.clear()
+
+    def set(self, guild_snowflake: int, snowflake: int, entry):
+        """
+        Sets the entry of an emote (used for loading the entries from the database).
+
+        Parameters
+        ----------
+        - guild_snowflake: `int` - Snowflake of the guild the emote belongs to.
+        - snowflake:       `int` - Snowflake of the emote.
+        - entry:           `any` - The entry, named by the emote's name.
+        """
+        self.guilds.setdefault(guild_snowflake, {})[snowflake] = entry
+        self.names.setdefault(guild_snowflake, {})[entry.name] = snowflake
+
+    def entry(self, guild_snowflake: int, snowflake: int, name: str, create: Callable[[], object]):
+        """
+        Returns the entry of a used emote, the replaced emote's entry (same name) or a new entry.
+
+        Parameters
+        ----------
+        - guild_snowflake: `int`      - Snowflake of the guild the emote was used in.
+        - snowflake:       `int`      - Snowflake of the emote.
+        - name:            `str`      - Current name of the emote.
+        - create:          `Callable` - Returns a new entry named name.
+        """
+        guild = self.guilds.setdefault(guild_snowflake, {})
+        names = self.names.setdefault(guild_snowflake, {})
+        entry = guild.get(snowflake)
+        if entry is None:
+            replaced = names.get(name)
+            entry = guild.pop(replaced, None) if replaced is not None else None
+            if entry is None:
+                entry = create()
+
+            guild[snowflake] = entry
+
+        if entry.name != name:
+            names.pop(entry.name, None)
+            entry.name = name
+
+        names[name] = snowflake
+        return entry
+
+
+class LiveCounters(GuildEmotes):
+    """
+    In-memory per-guild emote counters (all time total and daily counts of last days days).
+    Loaded from the database once (Manager.load_counters) and then updated together with every logged emote,
+    so the statistics are answered without querying the database.
+    Entries are EmoteCounter, see GuildEmotes.
+
+    Parameters
+    ----------
+    - days: `int` - Number of days of daily counts to keep.
+    """
+    def __init__(self, days: int = 30) -> None:
+        super().__init__()
+        self.days: int = days
+
+    def insert(self, guild_snowflake: int, snowflake: int, name: str, total: int) -> EmoteCounter:
+        """
+        Creates counters of an emote (used for loading the counters from the database).
+
+        Parameters
+        ----------
+        - guild_snowflake: `int` - Snowflake of the guild the emote belongs to.
+        - snowflake:       `int` - Snowflake of the emote.
+        - name:            `str` - Name of the emote.
+        - total:           `int` - All time count of the emote.
+        """
+        counter = EmoteCounter(name, total, DayRing(self.days, dt.date.today().toordinal()))
+        self.set(guild_snowflake, snowflake, counter)
+        return counter
+
+    def add(self, guild_snowflake: int, emotes: List[Dict], day: dt.date):
+        """
+        Increases the counters of emotes.
+
+        Parameters
+        ----------
+        - guild_snowflake: `int`        - Snowflake of the guild the emotes were used in.
+        - emotes:          `List[Dict]` - The emotes ({"name": ..., "snowflake": ...}).
+        - day:             `date`       - The day the emotes were used.
+        """
+        day = day.toordinal()
+        for emote in emotes:
+            name = emote["name"]
+            counter = self.entry(guild_snowflake, emote["snowflake"], name, lambda: EmoteCounter(name, 0, DayRing(self.days, day)))
+            counter.total += 1
+            counter.ring.add(day, 1)
+
+    def statistics(self, guild_snowflake: int, limit: int, day_limit: int, emote_snowflake: int=None, ascending=False) -> List[Tuple]:
+        """
+        Returns (name, snowflake, total count, count in last day_limit days) of the guild's emotes,
+        ordered by the count in last day_limit days.
+        Same as Manager.statistics.
+        """
+        guild = self.guilds.get(guild_snowflake)
+        if not guild:
+            return []
+
+        if emote_snowflake is not None:
+            counter = guild.get(emote_snowflake)
+            guild = {emote_snowflake: counter} if counter is not None else {}
+
+        today = dt.date.today().toordinal()
+        rows = []
+        for snowflake, counter in guild.items():
+            count = counter.ring.window(day_limit, today)
+            if count:
+                rows.append((counter.name, snowflake, counter.total, count))
+
+        select_ = heapq.nsmallest if ascending else heapq.nlargest
+        return select_(limit, rows, key=lambda row: row[3])
+
+
+class SpaceSaving:
+    """
+    Space-Saving summary of the most frequent keys of a stream, using at most capacity entries.
+    When a new key arrives and the summary is full, the key with the smallest count is replaced,
+    and the new key inherits that count as it's possible overestimation (error).
+
+    Error bounds (total is the sum of all the added counts):
+    - A reported count never underestimates: count - error <= true count <= count.
+    - error <= total / capacity, so any key with a true count above total / capacity is always present.
+
+    The smallest count is found through a min-heap of (count, key) with lazy invalidation: every increase pushes
+    the new count and outdated items are skipped when popped, so an update is amortized O(log capacity).
+    The heap is rebuilt from the entries once it grows past HEAP_FACTOR * capacity items.
+
+    Parameters
+    ----------
+    - capacity: `int` - Maximum number of tracked keys.
+    """
+    __slots__ = ("capacity", "entries", "total", "heap")
+    HEAP_FACTOR = 4
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity: int = capacity
+        self.entries: Dict[int, List] = {}
+        "Keys are the tracked keys, values [count, error, name]."
+        self.total: int = 0 #: Sum of all the added counts.
+        self.heap: List[Tuple[int, int]] = []
+        "Min-heap of (count, key), an item is outdated if the key's current count differs."
+
+    def add(self, key: int, name: str, count: int = 1):
+        """
+        Increases the key's count.
+
+        Parameters
+        ----------
+        - key:   `int` - The key (emote snowflake).
+        - name:  `str` - Name reported with the key.
+        - count: `int` - The amount to add.
+        """
+        self.total += count
+        entry = self.entries.get(key)
+        if entry is None:
+            if len(self.entries) < self.capacity:
+                entry = self.entries[key] = [0, 0, name]
+            else:
+                minimum = self.pop_minimum()
+                entry = self.entries[key] = [minimum, minimum, name]
+
+        entry[0] += count
+        entry[2] = name
+        heap = self.heap
+        heapq.heappush(heap, (entry[0], key))
+        if len(heap) > self.HEAP_FACTOR * self.capacity:
+            heap[:] = [(tracked[0], tracked_key) for tracked_key, tracked in self.entries.items()]
+            heapq.heapify(heap)
+
+    def pop_minimum(self) -> int:
+        """
+        Removes the key with the smallest count and returns it's count.
+        Every tracked key has an item with it's current count inside the heap,
+        so the first popped item that matches it's key's current count is the smallest.
+        """
+        while True:
+            count, key = heapq.heappop(self.heap)
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == count:
+                del self.entries[key]
+                return count
+
+    def top(self, limit: int) -> List[Tuple[str, int, int, int]]:
+        """
+        Returns (name, key, count, error) of limit keys with the highest counts.
+
+        Parameters
+        ----------
+        - limit: `int` - Number of keys to return.
+        """
+        return [
+            (name, key, count, error)
+            for key, (count, error, name) in heapq.nlargest(limit, self.entries.items(), key=lambda item: item[1][0])
+        ]
+
+
+class HeavyHitters:
+    """
+    Approximate most used emotes of the current window (eg. hour or day) per guild and across all guilds.
+    Each window is summarized by Space-Saving (see SpaceSaving for error bounds),
+    so the memory is bounded to capacity emotes per guild (and capacity across all guilds) regardless of traffic.
+    Windows are aligned to the local time and the summaries are reset when a new window starts.
+
+    Parameters
+    ----------
+    - capacity: `int`   - Maximum number of tracked emotes per summary.
+    - window:   `float` - Length of the window in seconds.
+    """
+    def __init__(self, capacity: int, window: float) -> None:
+        self.capacity: int = capacity
+        self.window: float = window
+        self.start: float = 0 #: Timestamp at which the current window started.
+        self.guilds: Dict[int, SpaceSaving] = {}
+        "Keys are guild snowflakes, values summaries of the guild."
+        self.all: SpaceSaving = SpaceSaving(capacity) #: Summary across all guilds.
+
+    def advance(self, now: float):
+        """
+        Starts a new window if the current one has passed.
+
+        Parameters
+        ----------
+        - now: `float` - Current timestamp.
+        """
+        if now - self.start >= self.window:
+            offset = dt.datetime.fromtimestamp(now).astimezone().utcoffset().total_seconds()
+            self.start = now - (now + offset) % self.window
+            self.guilds.clear()
+            self.all = SpaceSaving(self.capacity)
+
+    def add(self, guild_snowflake: int, emotes: List[Dict], now: float):
+        """
+        Counts the emotes.
+
+        Parameters
+        ----------
+        - guild_snowflake: `int`        - Snowflake of the guild the emotes were used in.
+        - emotes:          `List[Dict]` - The emotes ({"name": ..., "snowflake": ...}).
+        - now:             `float`      - Timestamp of the usage.
+        """
+        self.advance(now)
+        guild = self.guilds.get(guild_snowflake)
+        if guild is None:
+            guild = self.guilds[guild_snowflake] = SpaceSaving(self.capacity)
+
+        for emote in emotes:
+            guild.add(emote["snowflake"], emote["name"])
+            self.all.add(emote["snowflake"], emote["name"])
+
+    def top(self, guild_snowflake: int, limit: int, now: float) -> List[Tuple[str, int, int, int]]:
+        """
+        Returns (name, snowflake, count, error) of the most used emotes in the current window.
+
+        Parameters
+        ----------
+        - guild_snowflake: `int`   - Snowflake of the guild (None for all guilds).
+        - limit:           `int`   - Number of emotes to return.
+        - now:             `float` - Current timestamp.
+        """
+        self.advance(now)
+        summary = self.all if guild_snowflake is None else self.guilds.get(guild_snowflake)
+        return summary.top(limit) if summary is not None else []
+
+
+def decay(score: float, elapsed: float, half_life: float) -> float:
+    """
+    Returns the score decayed for elapsed seconds (halved every half_life seconds).
+    """
+    return score * 0.5 ** (elapsed / half_life)
+
+
+class EmoteScore:
+    """
+    Decayed usage score of a single emote.
+
+    Parameters
+    ----------
+    - name:    `str`   - Name of the emote.
+    - score:   `float` - Score at the time of the last update.
+    - updated: `float` - Timestamp of the last update.
+    """
+    __slots__ = ("name", "score", "updated")
+
+    def __init__(self, name: str, score: float, updated: float) -> None:
+        self.name = name
+        self.score = score
+        self.updated = updated
+
+
+class DecayedScores(GuildEmotes):
+    """
+    Exponentially decayed usage scores of emotes per guild, every use adds 1 and the score halves every half_life seconds.
+    Scores only decay when they are updated or read (lazily, from the time of the last update), so an update is O(1).
+    Entries are EmoteScore, see GuildEmotes.
+
+    Parameters
+    ----------
+    - half_life: `float` - Number of seconds after which a score is halved.
+    """
+    def __init__(self, half_life: float) -> None:
+        super().__init__()
+        self.half_life: float = half_life
+
+    def insert(self, guild_snowflake: int, snowflake: int, name: str, score: float, updated: float):
+        """
+        Sets the score of an emote (used for loading the scores from the database).
+
+        Parameters
+        ----------
+        - guild_snowflake: `int`   - Snowflake of the guild the emote belongs to.
+        - snowflake:       `int`   - Snowflake of the emote.
+        - name:            `str`   - Name of the emote.
+        - score:           `float` - Score at the time of the last update.
+        - updated:         `float` - Timestamp of the last update.
+        """
+        self.set(guild_snowflake, snowflake, EmoteScore(name, score, updated))
+
+    def add(self, guild_snowflake: int, emotes: List[Dict], now: float):
+        """
+        Increases the scores of emotes.
+
+        Parameters
+        ----------
+        - guild_snowflake: `int`        - Snowflake of the guild the emotes were used in.
+        - emotes:          `List[Dict]` - The emotes ({"name": ..., "snowflake": ...}).
+        - now:             `float`      - Timestamp of the usage.
+        """
+        for emote in emotes:
+            name = emote["name"]
+            entry = self.entry(guild_snowflake, emote["snowflake"], name, lambda: EmoteScore(name, 0.0, now))
+            entry.score = decay(entry.score, now - entry.updated, self.half_life) + 1
+            entry.updated = now
+
+    def top(self, guild_snowflake: int, limit: int, now: float) -> List[Tuple[str, int, float]]:
+        """
+        Returns (name, snowflake, score) of limit emotes with the highest scores (decayed to now).
+
+        Parameters
+        ----------
+        - guild_snowflake: `int`   - Snowflake of the guild.
+        - limit:           `int`   - Number of emotes to return.
+        - now:             `float` - Current timestamp.
+        """
+        guild = self.guilds.get(guild_snowflake)
+        if not guild:
+            return []
+
+        return [
+            (entry.name, snowflake, decay(entry.score, now - entry.updated, self.half_life))
+            for snowflake, entry in heapq.nlargest(
+                limit, guild.items(), key=lambda item: decay(item[1].score, now - item[1].updated, self.half_life)
+            )
+        ]
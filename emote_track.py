@@ -1,17 +1,30 @@
 from typing import Callable, Coroutine, Dict, List, Tuple, overload
 import asyncio
+import datetime as dt
 import inspect
 import os
 import re
+import signal
 import time
 
 import _discord as discord
+import cache
+import counters
 import sql
 
 
 TOKEN = ""
 IS_USER = False
 PREFIX = "@@"
+DATABASE = "emotes.db"
+SHARDS = 0 # Number of database files the guilds are split into (0 for a single database), see split_db.py
+
+EMOTE_PATTERN = re.compile(r"<(a?):(\w+):(\d+)>")
+"Matches custom emotes (<:name:snowflake> and animated <a:name:snowflake>), captures the animated flag, name and snowflake."
+USER_PATTERN = re.compile(r"<@!?(\d+)>")
+"Matches user mentions (<@snowflake>), captures the snowflake."
+CHANNEL_PATTERN = re.compile(r"<#(\d+)>")
+"Matches channel mentions (<#snowflake>), captures the snowflake."
 
 
 class EmoteTracker:
@@ -24,16 +37,66 @@ class EmoteTracker:
     - days:     `int`     - How many days to use for last {days} days statistics.
     - sql_manager:  `Manager` - SQL sql_manager for communicating with the database.
     - dc_client: `Client` - Discord client object for interacting with discord API.
+    - reaction_cache_size: `int` - How many reactions (across all users) to remember for avoiding duplicated counting.
+    - reaction_cache_ttl: `float` - After how many seconds a remembered reaction is forgotten (None for never).
+    - hot_capacity: `int` - How many emotes per guild the approximate hourly and daily top emotes track (None to disable).
     """
-    def __init__(self, days: int, sql_manager: sql.Manager, dc_client: discord.Client):
+    def __init__(self, days: int, sql_manager: sql.Manager, dc_client: discord.Client, reaction_cache_size: int = 50000, reaction_cache_ttl: float = None,
+                 hot_capacity: int = None):
         self.days_to_use: int = days #: How many days to use for last {days} days statistics.
         self.sql_manager: sql.Manager = sql_manager #: SQL sql_manager for communicating with the database.
         self.dc_client: discord.Client = dc_client  #: Discord client object for interacting with discord API.
-        self.history_cache: Dict[int, List[Tuple[int, int]]] = {}
+        self.reaction_cache = cache.ReactionCache(reaction_cache_size, reaction_cache_ttl)
+        "Cache of recent (user_snowflake, message_snowflake, emote_snowflake) reactions"
+        self.guild_emotes: Dict[int, Dict[int, str]] = {}
+        """
+        Emote index dictionary which's keys are guild snowflakes.
+        For values it contains dictionaries that map emote snowflakes to emote names.
+        """
+        self.hot: Dict[str, counters.HeavyHitters] = {}
+        "Approximate top emotes of the current window, keys are window names (hour, day)."
+        if hot_capacity is not None:
+            self.hot = {"hour": counters.HeavyHitters(hot_capacity, 3600), "day": counters.HeavyHitters(hot_capacity, 86400)}
+
+    def index_guild(self, guild: discord.Guild, emojis: Tuple[discord.Emoji] = None) -> Dict[int, str]:
         """
-        History cache dictionary which's keys are user snowflakes.
-        For values it contains lists that contain tuples of message_snowflake and reaction_snowflake
+        (Re)builds the emote index of the guild.
+
+        Parameters:
+        -----------
+        - guild:  `discord.Guild` - The guild to index.
+        - emojis: `Tuple[discord.Emoji]` - The guild's emojis (defaults to guild.emojis).
+        """
+        index = {emoji.id: emoji.name for emoji in (guild.emojis if emojis is None else emojis)}
+        self.guild_emotes[guild.id] = index
+        return index
+
+    def remove_guild(self, guild: discord.Guild):
+        """
+        Removes the guild's emote index.
+
+        Parameters:
+        -----------
+        - guild:  `discord.Guild` - The guild that was removed.
         """
+        self.guild_emotes.pop(guild.id, None)
+
+    def get_guild_emotes(self, guild_id: int) -> Dict[int, str]:
+        """
+        Returns the emote index of the guild, building it if the guild was not yet indexed.
+        Returns None if the guild is unknown.
+
+        Parameters:
+        -----------
+        - guild_id:  `int` - Snowflake of the guild to return the index for.
+        """
+        index = self.guild_emotes.get(guild_id)
+        if index is None:
+            guild = self.dc_client.get_guild(guild_id)
+            if guild is not None:
+                index = self.index_guild(guild)
+
+        return index
 
     def get_message_emotes(self, message: discord.Message, duplicates: bool = False) -> list:
         """
@@ -44,23 +107,39 @@ class EmoteTracker:
         - message:    `discord.Message`  - The message object
         - duplicates: `bool` - Allow duplicated emotes in the returned list.
         """
-        proccessed_ids = []
+        content = message.content
+        if "<" not in content: # Every emote starts with '<'
+            return []
+
+        processed_ids = set()
         emotes = []
-        guild_emotes_snowflakes = [x.id for x in message.guild.emojis] # Only allow emotes from this server
-                                
-        for emote in re.findall(r"<:\w*:\d*>", message.content):
-            id = int(re.search(r"(?<=:)\d.*(?=>)",emote).group(0))
-            if (duplicates or id not in proccessed_ids) and id in guild_emotes_snowflakes: # If duplicates is False (not allowed) shortcircuit evaliaton for in check.
+        guild_emotes_snowflakes = self.get_guild_emotes(message.guild.id) # Only allow emotes from this server
+        for _, name, id in EMOTE_PATTERN.findall(content):
+            id = int(id)
+            if id in guild_emotes_snowflakes and (duplicates or id not in processed_ids):
                 emotes.append(
                     {
-                        "name" : re.search(r"(?<=<:).*(?=:)", emote).group(0),
+                        "name" : name,
                         "snowflake" : id
                     }
                 )
-                proccessed_ids.append(id)
+                processed_ids.add(id)
 
         return emotes
 
+    def count_hot(self, guild_id: int, emotes: list):
+        """
+        Counts the emotes inside the approximate top emotes of every window.
+
+        Parameters:
+        -----------
+        - guild_id: `int`  - Snowflake of the guild the emotes were used in.
+        - emotes:   `list` - The emotes ({"name": ..., "snowflake": ...}).
+        """
+        now = time.time()
+        for heavy_hitters in self.hot.values():
+            heavy_hitters.add(guild_id, emotes, now)
+
     @overload
     async def proccess(self, reaction: discord.RawReactionActionEvent):
         """
@@ -90,37 +169,24 @@ class EmoteTracker:
         if message is not None:
             emotes = self.get_message_emotes(message)
             if emotes:
-                self.sql_manager.insert_emote_log(emotes, message.guild)
+                await self.sql_manager.log_emotes(emotes, message.guild, message.author.id, message.channel.id)
+                self.count_hot(message.guild.id, emotes)
 
         elif reaction is not None:
-            self.history_cache: Dict[int, List[Tuple[int, int]]]
-            """
-            History cache dictionary which's keys are user snowflakes.
-            For values it contains lists that contain tuples of message_snowflake and reaction_snowflake
-            """
+            # Resolve everything from the raw payload, the message itself might not be cached anymore
             emote_id = reaction.emoji.id
-            message = self.dc_client.get_message(reaction.message_id)
-            if message is None:
+            if reaction.guild_id is None or emote_id is None: # Direct message or an unicode emoji
                 return
 
-            guild = message.channel.guild
-            guild_emoji_ids = [x.id for x in guild.emojis]
-            if emote_id not in guild_emoji_ids:
+            guild_emotes = self.get_guild_emotes(reaction.guild_id)
+            if guild_emotes is None or emote_id not in guild_emotes:
                 return
 
-            if reaction.user_id not in self.history_cache:
-                self.history_cache[reaction.user_id] = []
-
-            user_history = self.history_cache[reaction.user_id]
-            history_tuple = (reaction.message_id, reaction.emoji.id)
-
-            if history_tuple not in user_history: # This emote was not used on the same message (atlest not before reacting to 100 different messages)
-                # Only track 100 reactions for each user to avoid memory overflows
-                if len(user_history) == 100:
-                    user_history.pop(0)
-
-                user_history.append(history_tuple)
-                self.sql_manager.insert_emote_log([{"name": reaction.emoji.name, "snowflake" : reaction.emoji.id}], self.dc_client.get_guild(reaction.guild_id))
+            # Count the emote only once for the same user on the same message
+            if self.reaction_cache.add((reaction.user_id, reaction.message_id, emote_id)):
+                emotes = [{"name": reaction.emoji.name, "snowflake" : emote_id}]
+                await self.sql_manager.log_emotes(emotes, self.dc_client.get_guild(reaction.guild_id), reaction.user_id, reaction.channel_id)
+                self.count_hot(reaction.guild_id, emotes)
 
 
 class CommandProxy:
@@ -208,6 +274,8 @@ class Bot(discord.Client):
             return True
         if value == "False":
             return False
+        if re.search(r"^\d{4}-\d{2}-\d{2}$", value.strip('"')) is not None:
+            return dt.date.fromisoformat(value.strip('"'))
         if re.search(r"^[0-9]+(?!.)", value, re.MULTILINE) is not None:
             return int(value)
         if re.search(r"^[0-9]+\.[0-9]+(?!.)", value) is not None:
@@ -226,29 +294,68 @@ class Bot(discord.Client):
         command_name = command_name.group(0).lower()
         content = content.lstrip(command_name).strip()
         command_name = command_name.lstrip(self.prefix)
-        kwargs_search: List[str] = re.findall(r'--\w+ \w+|--\w+ ".*?"|--\w+ \[.*\]', content)
+        kwargs_search: List[str] = re.findall(r'--\w+ \d{4}-\d{2}-\d{2}|--\w+ <[^<>\s]+>|--\w+ \w+|--\w+ ".*?"|--\w+ \[.*\]', content)
         kwargs = {}
         for kwarg in kwargs_search:
             content = content.replace(kwarg, "")
             kwarg = kwarg.lstrip("--").split(' ', 1)
             kwargs[kwarg[0]] = self.transform_value(kwarg[1])
         
-        args = [self.transform_value(x[0] if x[0] != '' else x[1]) for x in re.findall(r'(\b(?<!")[.\w]+(?!")\b)|(".+?")', content)]
+        # Mentions (<:emote:snowflake>, <#channel>, <@user>) are kept whole
+        args = [self.transform_value(next(group for group in x if group)) for x in re.findall(r'(<[^<>\s]+>)|(\b(?<!")[.\w]+(?!")\b)|(".+?")', content)]
         
         return CommandProxy(command_name, *args, **kwargs)
     
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
         await emote_tracker.proccess(reaction=payload)
 
+    async def on_guild_available(self, guild: discord.Guild):
+        emote_tracker.index_guild(guild)
+        await sql_manager.preload_guild_async(guild.id)
+
+    async def on_guild_join(self, guild: discord.Guild):
+        emote_tracker.index_guild(guild)
+        await sql_manager.preload_guild_async(guild.id)
+
+    async def on_guild_remove(self, guild: discord.Guild):
+        emote_tracker.remove_guild(guild)
+
+    async def on_guild_emojis_update(self, guild: discord.Guild, before: Tuple[discord.Emoji], after: Tuple[discord.Emoji]):
+        emote_tracker.index_guild(guild, after)
+
         
 
 
 intents = discord.Intents.default()
 intents.message_content=True
 intents.messages=True
-sql_manager = sql.Manager("emotes.db")
+manager_options = dict(
+    live_days=30, profile="performance", journal=True, trending_half_life=6 * 3600, heatmaps=True,
+    pair_limit=5000, user_days=30, channels=True, leaderboard_refresh=600
+)
+if SHARDS:
+    sql_manager = sql.ShardedManager(DATABASE.replace(".db", "") + "_{}.db", SHARDS, **manager_options)
+else:
+    sql_manager = sql.Manager(DATABASE, **manager_options)
+
 dc_client = Bot(PREFIX, intents=intents)
-emote_tracker = EmoteTracker(30, sql_manager, dc_client)
+emote_tracker = EmoteTracker(30, sql_manager, dc_client, hot_capacity=100)
+
+
+def emote_markdown(name: str, snowflake: int) -> str:
+    """
+    Returns the markdown that displays the emote, <a:name:snowflake> for animated emotes.
+    Whether the emote is animated is a property of the emoji, it's taken from the client's emoji cache
+    (emotes that are no longer cached are displayed as static).
+
+    Parameters:
+    -----------
+    - name:      `str` - Name of the emote.
+    - snowflake: `int` - Snowflake of the emote.
+    """
+    emoji = dc_client.get_emoji(snowflake)
+    return f"<{'a' if emoji is not None and emoji.animated else ''}:{name}:{snowflake}>"
+
 
 async def main():
     sql_manager.start()
@@ -305,7 +412,7 @@ __Available commands:__
 
 
 @dc_client.register_command("usage")
-async def emote_usage(message: discord.Message, emote=None, ascending=False, columns=3, limit=40):
+async def emote_usage(message: discord.Message, emote=None, ascending=False, columns=3, limit=40, since=None, until=None, channel=None):
     """
     Returns a list of emotes and their usage.
     
@@ -319,22 +426,37 @@ async def emote_usage(message: discord.Message, emote=None, ascending=False, col
         How many emotes to print in single row
     limit: int
         How many emotes to display
+    since: date
+        (YYYY-MM-DD) Count the usage from this day on instead of the last 30 days (days older than the kept history are refused).
+    until: date
+        (YYYY-MM-DD) Count the usage up to (and including) this day instead of the last 30 days.
+    channel: str
+        Mention of the channel to count the usage in (Counts the whole server if not given).
     """
     if limit > 40:
         raise ValueError("'limit' parameter has a hard limit of 40!")
 
     if emote is not None:
-        match_ = re.search(r"<:\w+:[0-9]+>", emote)
+        match_ = EMOTE_PATTERN.search(str(emote))
         if match_ is not None:
-            emote = int(re.search(r"(?<=:)[0-9]+(?=>)", match_.group(0)).group(0))
+            emote = int(match_.group(3))
+
+    for date in (since, until):
+        if date is not None and not isinstance(date, dt.date):
+            raise ValueError("'since' and 'until' parameters must be dates in YYYY-MM-DD format!")
+
+    if channel is not None:
+        match_ = CHANNEL_PATTERN.search(str(channel))
+        channel = int(match_.group(1)) if match_ is not None else channel
+        if not isinstance(channel, int):
+            raise ValueError("'channel' parameter must be a channel mention or a snowflake!")
 
     content = ""
     contents = []
-    for name, snowflake, total_count, count30day in sql_manager.statistics(message.guild.id, limit, emote_tracker.days_to_use, emote, ascending):
-        contents.append("<:{}:{}> `{:5d}` `{:5d}`"
+    for name, snowflake, total_count, count30day in await sql_manager.statistics_async(message.guild.id, limit, emote_tracker.days_to_use, emote, ascending, since, until, channel):
+        contents.append("{} `{:5d}` `{:5d}`"
             .format(
-                name,
-                snowflake,
+                emote_markdown(name, snowflake),
                 total_count,
                 count30day
             )
@@ -342,12 +464,276 @@ async def emote_usage(message: discord.Message, emote=None, ascending=False, col
 
     content  = "\n".join("**|**".join(contents[i*columns:(i+1)*columns]) for i in range(len(contents)//columns+1))
     if content:
-        content = "Emote, Total count, Last 30 days\n" + content
+        if since is not None or until is not None:
+            period = f"{since or 'Beginning'} - {until or 'Today'}"
+        else:
+            period = f"Last {emote_tracker.days_to_use} days"
+
+        if channel is not None:
+            period += f" in <#{channel}>"
+
+        content = f"Emote, Total count, {period}\n" + content
     else:
         content = "Ni nobenih podatkov!"
 
     await message.reply(content)
 
+@dc_client.register_command("hot")
+async def hot(message: discord.Message, window="hour", everywhere=False, limit=10):
+    """
+    Returns the most used emotes of the current hour or day (approximate).
+    Counts are upper bounds, the ± value is the most they can be overestimated by.
+
+    Parameters
+    --------------
+    window: str
+        (hour/day) The window to return the emotes for.
+    everywhere: bool
+        (True/False) Return the most used emotes across all the guilds instead of this guild.
+    limit: int
+        How many emotes to display
+    """
+    if limit > 40:
+        raise ValueError("'limit' parameter has a hard limit of 40!")
+
+    heavy_hitters = emote_tracker.hot.get(window)
+    if heavy_hitters is None:
+        raise ValueError(f"'window' parameter must be one of: {', '.join(emote_tracker.hot) or 'None (disabled)'}!")
+
+    contents = []
+    for name, snowflake, count, error in heavy_hitters.top(None if everywhere else message.guild.id, limit, time.time()):
+        contents.append(f"{emote_markdown(name, snowflake)} `{count:5d}`" + (f" `±{error}`" if error else ""))
+
+    if contents:
+        content = f"Emote, Count this {window}\n" + "\n".join(contents)
+    else:
+        content = "Ni nobenih podatkov!"
+
+    await message.reply(content)
+
+
+@dc_client.register_command("trending")
+async def trending(message: discord.Message, limit=10):
+    """
+    Returns the emotes that are trending right now.
+    Each use adds 1 to the emote's score and scores halve every {half_life:g} hours.
+
+    Parameters
+    --------------
+    limit: int
+        How many emotes to display
+    """
+    if limit > 40:
+        raise ValueError("'limit' parameter has a hard limit of 40!")
+
+    contents = []
+    for name, snowflake, score in sql_manager.trending(message.guild.id, limit):
+        contents.append(f"{emote_markdown(name, snowflake)} `{score:8.2f}`")
+
+    if contents:
+        content = "Emote, Score\n" + "\n".join(contents)
+    else:
+        content = "Ni nobenih podatkov!"
+
+    await message.reply(content)
+
+
+trending.__doc__ = trending.__doc__.format(half_life=(manager_options["trending_half_life"] or 0) / 3600)
+
+
+@dc_client.register_command("heatmap")
+async def heatmap(message: discord.Message, emote=None):
+    """
+    Returns the usage per hour of the week as a heatmap (darker is more used).
+
+    Parameters
+    --------------
+    emote: str
+        Returns the heatmap of only this emote (Returns the heatmap of all emotes if not given).
+    """
+    if emote is not None:
+        match_ = EMOTE_PATTERN.search(str(emote))
+        emote = int(match_.group(3)) if match_ is not None else emote
+        if not isinstance(emote, int):
+            raise ValueError("'emote' parameter must be an emote or it's snowflake!")
+
+    counts = await sql_manager.heatmap_async(message.guild.id, emote)
+    highest = max(counts)
+    if not highest:
+        await message.reply("Ni nobenih podatkov!")
+        return
+
+    shades = " ░▒▓█"
+    rows = ["    0     6     12    18    "]
+    for day, day_name in enumerate(("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")):
+        rows.append(day_name + " " + "".join(shades[-(-count * (len(shades) - 1) // highest)] for count in counts[day * 24:(day + 1) * 24]))
+
+    await message.reply(f"Usage per hour (most used hour: `{highest}`)\n```\n" + "\n".join(rows) + "\n```")
+
+
+@dc_client.register_command("partners")
+async def partners(message: discord.Message, emote: str, limit=10):
+    """
+    Returns the emotes that are most often used together with the emote (inside the same message).
+
+    Parameters
+    --------------
+    emote: str
+        The emote to return the partners of.
+    limit: int
+        How many emotes to display
+    """
+    if limit > 40:
+        raise ValueError("'limit' parameter has a hard limit of 40!")
+
+    match_ = EMOTE_PATTERN.search(str(emote))
+    emote = int(match_.group(3)) if match_ is not None else emote
+    if not isinstance(emote, int):
+        raise ValueError("'emote' parameter must be an emote or it's snowflake!")
+
+    contents = []
+    for name, snowflake, count in await sql_manager.partners_async(message.guild.id, emote, limit):
+        contents.append(f"{emote_markdown(name or 'emote', snowflake)} `{count:5d}`")
+
+    if contents:
+        content = "Emote, Times used together\n" + "\n".join(contents)
+    else:
+        content = "Ni nobenih podatkov!"
+
+    await message.reply(content)
+
+
+@dc_client.register_command("top")
+async def top(message: discord.Message, user=None, limit=10):
+    """
+    Returns the emotes the user used most in the last 30 days.
+
+    Parameters
+    --------------
+    user: str
+        Mention of the user (Returns your own emotes if not given).
+    limit: int
+        How many emotes to display
+    """
+    if limit > 40:
+        raise ValueError("'limit' parameter has a hard limit of 40!")
+
+    if user is None:
+        user = message.author.id
+    else:
+        match_ = USER_PATTERN.search(str(user))
+        user = int(match_.group(1)) if match_ is not None else user
+        if not isinstance(user, int):
+            raise ValueError("'user' parameter must be a mention or a snowflake!")
+
+    contents = []
+    for name, snowflake, count in await sql_manager.user_statistics_async(message.guild.id, user, limit, emote_tracker.days_to_use):
+        contents.append(f"{emote_markdown(name, snowflake)} `{count:5d}`")
+
+    if contents:
+        content = f"Emote, Last {emote_tracker.days_to_use} days\n" + "\n".join(contents)
+    else:
+        content = "Ni nobenih podatkov!"
+
+    await message.reply(content)
+
+
+@dc_client.register_command("fans")
+async def fans(message: discord.Message, emote: str, limit=10):
+    """
+    Returns the users that used the emote most in the last 30 days.
+
+    Parameters
+    --------------
+    emote: str
+        The emote to return the users of.
+    limit: int
+        How many users to display
+    """
+    if limit > 40:
+        raise ValueError("'limit' parameter has a hard limit of 40!")
+
+    match_ = EMOTE_PATTERN.search(str(emote))
+    emote = int(match_.group(3)) if match_ is not None else emote
+    if not isinstance(emote, int):
+        raise ValueError("'emote' parameter must be an emote or it's snowflake!")
+
+    contents = []
+    for user, count in await sql_manager.emote_users_async(message.guild.id, emote, limit, emote_tracker.days_to_use):
+        contents.append(f"<@{user}> `{count:5d}`")
+
+    if contents:
+        content = f"User, Last {emote_tracker.days_to_use} days\n" + "\n".join(contents)
+    else:
+        content = "Ni nobenih podatkov!"
+
+    await message.reply(content, allowed_mentions=discord.AllowedMentions.none())
+
+
+@dc_client.register_command("unused")
+async def unused(message: discord.Message, days=30, limit=40):
+    """
+    Returns the server's emotes that were not used in the last days days, never used and then the longest unused first.
+
+    Parameters
+    --------------
+    days: int
+        Emotes used within this many days are not listed.
+    limit: int
+        How many emotes to display
+    """
+    if limit > 40:
+        raise ValueError("'limit' parameter has a hard limit of 40!")
+
+    guild_emotes = emote_tracker.get_guild_emotes(message.guild.id) or {}
+    today = dt.date.today()
+    contents = []
+    for snowflake, last_used in (await sql_manager.unused_emotes_async(message.guild.id, list(guild_emotes), days))[:limit]:
+        if last_used is None:
+            used = "never"
+        elif last_used == sql.CUMULATIVE_BASE:
+            used = "before tracking by day"
+        else:
+            used = f"{last_used} ({(today - last_used).days} days ago)"
+        contents.append(f"{emote_markdown(guild_emotes[snowflake], snowflake)} `{used}`")
+
+    if contents:
+        content = "Emote, Last used\n" + "\n".join(contents)
+    else:
+        content = f"All the emotes were used in the last {days} days!"
+
+    await message.reply(content)
+
+
+@dc_client.register_command("leaderboard")
+async def leaderboard(message: discord.Message, columns=3, limit=30):
+    """
+    Returns the most used emotes across all the servers in the last 30 days (refreshed every 10 minutes).
+
+    Parameters
+    --------------
+    columns: int
+        How many emotes to print in single row
+    limit: int
+        How many emotes to display
+    """
+    if limit > 40:
+        raise ValueError("'limit' parameter has a hard limit of 40!")
+
+    contents = [
+        f"{emote_markdown(name, snowflake)} `{total_count:5d}` `{count:5d}`"
+        for name, snowflake, total_count, count in sql_manager.global_leaderboard(limit)
+    ]
+    content = "\n".join("**|**".join(contents[i*columns:(i+1)*columns]) for i in range(len(contents)//columns+1))
+    if content:
+        updated = dt.datetime.fromtimestamp(sql_manager.leaderboard.updated).strftime("%H:%M")
+        content = f"Emote, Total count, Last 30 days on all servers (updated at {updated})\n" + content
+    else:
+        content = "Ni nobenih podatkov!"
+
+    await message.reply(content)
+
+
 @dc_client.register_command("reboot")
 async def reboot(message: discord.Message, time: int):
     """
@@ -418,9 +804,15 @@ async def mono(message: discord.Message, content: str=None, message_id: int=None
 
 
 
-try:
-    loop = asyncio.get_event_loop()
-    loop.create_task(main())
-    loop.run_forever()
-except:
-    exit(0)
\ No newline at end of file
+if __name__ == "__main__":
+    try:
+        loop = asyncio.get_event_loop()
+        loop.create_task(main())
+        if os.name != "nt":
+            loop.add_signal_handler(signal.SIGTERM, loop.stop) # nohup'ed process is stopped with SIGTERM
+        loop.run_forever()
+    except:
+        pass
+    finally:
+        loop.run_until_complete(sql_manager.stop()) # Write the queued emote logs before exiting
+        exit(0)
\ No newline at end of file
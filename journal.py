@@ -0,0 +1,219 @@
+from typing import Iterator, List, Tuple
+import datetime as dt
+import json
+import os
+import threading
+
+
+class Journal:
+    """
+    Append-only journal of emote logs, written before the logs are applied to the database.
+    Each log is a JSON line with a sequence number, the database stores the sequence number of the last applied log,
+    so replaying the journal after a crash is idempotent.
+    Each log is written through to the operating system by append() (line buffered), so a killed process loses none of them,
+    only making them durable against a power loss (fsync) is batched with sync().
+    The logs are split into numbered segment files (filename.0, filename.1, ...), a new segment is started by rotate()
+    and the segments whose logs are all applied are removed by checkpoint(), so the journal doesn't grow under steady load.
+
+    Parameters
+    ----------
+    - filename: `str` - Path prefix of the segment files.
+    """
+    def __init__(self, filename: str) -> None:
+        self.filename: str = filename
+        self.file = None
+        self.number: int = 0 #: Number of the segment being appended to.
+        self.first: int = 0 #: Sequence number of the last log before the segment being appended to.
+        self.segments: List[Tuple[int, int]] = [] #: (number, sequence number of the last log) of the rotated segments.
+        self.lock = threading.Lock() #: Serializes syncing and closing of the segments (other threads).
+        self.seq: int = 0 #: Sequence number of the last appended log.
+        self.synced: int = 0 #: Sequence number of the last log that was made durable.
+
+    def path(self, number: int) -> str:
+        """
+        Returns the path of the segment file.
+
+        Parameters
+        ----------
+        - number: `int` - Number of the segment.
+        """
+        return f"{self.filename}.{number}"
+
+    def numbers(self) -> List[int]:
+        """
+        Returns the numbers of the existing segment files, in the order they were written.
+        """
+        directory, prefix = os.path.split(self.filename)
+        numbers = []
+        for name in os.listdir(directory or "."):
+            number = name[len(prefix) + 1:]
+            if name.startswith(prefix + ".") and number.isdigit():
+                numbers.append(int(number))
+
+        return sorted(numbers)
+
+    def open(self, seq: int):
+        """
+        Removes the existing segments (their logs must be applied, see replay()) and opens a new one for appending.
+
+        Parameters
+        ----------
+        - seq: `int` - Sequence number of the last used log, new logs continue from it.
+        """
+        for number in self.numbers():
+            os.remove(self.path(number))
+
+        self.seq = self.synced = self.first = seq
+        self.number = 0
+        self.segments = []
+        self.file = open(self.path(self.number), "w", encoding="utf-8", buffering=1)
+
+    def close(self):
+        """
+        Syncs and closes the journal.
+        """
+        if self.file is not None:
+            self.flush()
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    def append(self, guild_snowflake: int, guild_name: str, day: dt.date, emotes: List[dict], hour: int = None,
+               user_snowflake: int = None, channel_snowflake: int = None) -> int:
+        """
+        Appends the log to the journal, the line is written to the operating system right away
+        (not yet durable against a power loss, see sync()).
+
+        Parameters
+        ----------
+        - guild_snowflake:   `int`        - Snowflake of the guild the emotes were used in.
+        - guild_name:        `str`        - Name of the guild.
+        - day:               `date`       - The day the emotes were used.
+        - emotes:            `List[dict]` - The emotes ({"name": ..., "snowflake": ...}).
+        - hour:              `int`        - The hour of the week the emotes were used in.
+        - user_snowflake:    `int`        - Snowflake of the user that used the emotes.
+        - channel_snowflake: `int`        - Snowflake of the channel the emotes were used in.
+
+        Returns
+        ----------
+        The log's sequence number.
+        """
+        self.seq += 1
+        self.file.write(
+            json.dumps(
+                {
+                    "seq": self.seq,
+                    "guild": guild_snowflake,
+                    "name": guild_name,
+                    "day": day.isoformat(),
+                    "emotes": [[emote["name"], emote["snowflake"]] for emote in emotes],
+                    "hour": hour,
+                    "user": user_snowflake,
+                    "channel": channel_snowflake
+                },
+                separators=(",", ":")
+            ) + "\n"
+        )
+        return self.seq
+
+    def flush(self) -> int:
+        """
+        Writes the buffered logs to the operating system (append() already does, the segments are line buffered).
+        Must be called from the same thread as append().
+
+        Returns
+        ----------
+        Sequence number of the last flushed log (pass it to sync()).
+        """
+        self.file.flush()
+        return self.seq
+
+    def sync(self, seq: int = None, file=None):
+        """
+        Makes flushed logs durable (fsync). Can be called from another thread.
+
+        Parameters
+        ----------
+        - seq:  `int`  - Sequence number returned by flush().
+        - file: `file` - The segment that was flushed (the current one by default), a closed segment is already durable.
+        """
+        file = self.file if file is None else file
+        with self.lock:
+            if not file.closed:
+                os.fsync(file.fileno())
+
+        self.synced = self.seq if seq is None else seq
+
+    def rotate(self):
+        """
+        Starts a new segment, so the current one can be removed once its logs are applied.
+        Must be called from the same thread as append().
+
+        Returns
+        ----------
+        The previous segment's file (close it with close_segment()), None if the current segment is empty and was kept.
+        """
+        if self.seq == self.first:
+            return None
+
+        file = self.file
+        file.flush()
+        self.segments.append((self.number, self.seq))
+        self.number += 1
+        self.first = self.seq
+        self.file = open(self.path(self.number), "w", encoding="utf-8", buffering=1)
+        return file
+
+    def close_segment(self, file):
+        """
+        Makes the rotated segment durable and closes it. Can be called from another thread.
+
+        Parameters
+        ----------
+        - file: `file` - The file returned by rotate().
+        """
+        with self.lock:
+            os.fsync(file.fileno())
+            file.close()
+
+    def checkpoint(self, applied: int):
+        """
+        Removes the rotated segments whose logs are all applied to the database.
+        Must be called from the same thread as rotate() and after their close_segment() finished.
+
+        Parameters
+        ----------
+        - applied: `int` - Sequence number of the last log applied to the database.
+        """
+        while self.segments and self.segments[0][1] <= applied:
+            number, _ = self.segments.pop(0)
+            os.remove(self.path(number))
+
+    def replay(self, applied: int) -> Iterator[Tuple[int, int, str, dt.date, List[dict], int, int, int]]:
+        """
+        Yields (seq, guild snowflake, guild name, day, emotes, hour of the week, user snowflake, channel snowflake) of logs that were not yet applied to the database.
+        Segments are read in the order they were written, a partially written last line of a segment (crash during append) is ignored.
+
+        Parameters
+        ----------
+        - applied: `int` - Sequence number of the last log applied to the database.
+        """
+        for number in self.numbers():
+            with open(self.path(number), "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        log = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+
+                    if log["seq"] > applied:
+                        yield (
+                            log["seq"],
+                            log["guild"],
+                            log["name"],
+                            dt.date.fromisoformat(log["day"]),
+                            [{"name": name, "snowflake": snowflake} for name, snowflake in log["emotes"]],
+                            log.get("hour"),
+                            log.get("user"),
+                            log.get("channel")
+                        )
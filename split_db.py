@@ -0,0 +1,20 @@
+"""
+Splits an existing emote database into hash partitioned shards used by sql.ShardedManager.
+
+Usage: python split_db.py <database> <shards> [filename pattern]
+eg. python split_db.py emotes.db 4 emotes_{}.db
+"""
+import sys
+
+import sql
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in {3, 4}:
+        print(__doc__)
+        exit(1)
+
+    filename, shards = sys.argv[1], int(sys.argv[2])
+    filename_pattern = sys.argv[3] if len(sys.argv) == 4 else filename.replace(".db", "") + "_{}.db"
+    sql.split_database(filename, filename_pattern, shards)
+    print(f"Split {filename} into {shards} shards: {filename_pattern}")
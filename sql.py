@@ -1,130 +1,1582 @@
-from typing import List, Tuple
+from typing import Callable, Dict, List, Tuple
+import os
+import sqlite3
 from sqlalchemy import (
                             Column,
                             ForeignKey,
+                            Index,
                             Integer,
                             Date,
+                            Float,
                             BigInteger,
+                            LargeBinary,
+                            MetaData,
+                            PrimaryKeyConstraint,
+                            Table,
                             String,
                             UniqueConstraint,
+                            bindparam,
                             create_engine,
+                            event,
+                            literal_column,
+                            union_all,
+                            inspect,
                             text,
-                            or_,
-                            and_
+                            tuple_
                        )
+from sqlalchemy.engine import Connection
 from sqlalchemy.orm import declarative_base, sessionmaker, Session
-from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy import delete, func, select
+from concurrent.futures import ThreadPoolExecutor
 import datetime as dt
 import asyncio
+import heapq
+import re
+import time
+
+import cache
+import counters
+import journal as journals
 
 sqlBase = declarative_base()
 
+PROFILES: Dict[str, Dict[str, object]] = {
+    "default": {},
+    "performance": {
+        "journal_mode": "WAL", # Readers don't block the writer and the writer doesn't block readers
+        "synchronous": "NORMAL", # With WAL, a power loss can only lose the last commits, the database stays consistent
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024, # In KiB
+        "temp_store": "MEMORY",
+    },
+}
+"SQLite PRAGMA profiles, the profile's pragmas are applied to every new connection."
+
+MIGRATIONS: List[Callable[[Connection], None]] = []
+"Schema migrations, the database's schema version (PRAGMA user_version) is the number of applied migrations."
+
+
+def migration(fnc: Callable[[Connection], None]):
+    """~ decorator ~
+    @Info: Registers the function as the next schema migration"""
+    MIGRATIONS.append(fnc)
+    return fnc
+
+
+CUMULATIVE_BASE = dt.date(1970, 1, 1)
+"Day of the prefix sum rows holding usage older than any tracked day, it's older than any window that can be queried."
+
+
+class BatchEntry:
+    """~ class ~
+    @Info: Aggregated usage of an emote on a day inside a write batch (see Manager.aggregate).
+    @Param:
+        - guild_name ~ Name of the server
+        - name ~ Name of the emote
+        - count ~ Number of uses"""
+    __slots__ = ("guild_name", "name", "count", "hours", "partners", "users", "channels")
+
+    def __init__(self, guild_name: str, name: str, count: int = 0) -> None:
+        self.guild_name = guild_name
+        self.name = name
+        self.count = count
+        self.hours: Dict[int, int] = {} #: Counts per hour of the week
+        self.partners: Dict[int, int] = {} #: Co-occurrence counts, keyed by the other emote's snowflake
+        self.users: Dict[int, int] = {} #: Counts per user snowflake
+        self.channels: Dict[int, int] = {} #: Counts per channel snowflake
+
 
 class Manager:
     """~ class ~
-    @Info: Used for managing the sql database"""
-    def __init__(self, filename) -> None:
+    @Info: Used for managing the sql database.
+    Emote logs are buffered in memory and written to the database in batches by a background writer.
+    All the database work started from coroutines runs inside a dedicated database thread,
+    the synchronous methods remain available for scripts.
+    @Param:
+        - filename ~ Path to the SQLite database file
+        - batch_size ~ Maximum number of queued logs aggregated into a single transaction
+        - flush_interval ~ Maximum number of seconds a queued log waits before being written
+        - max_pending ~ Maximum number of queued logs; producers wait when the writer falls behind
+        - storage ~ How daily counts are stored: "daily" (EmoteDaily row per day), "ring" (EmoteRing array per emote)
+                    or "monthly" (EmoteDaily_YYYYMM table per month)
+        - ring_days ~ Number of days kept by the "ring" storage
+        - live_days ~ Number of days kept by the in-memory counters that answer statistics_async (None to disable them)
+        - cache_size ~ Maximum number of cached statistics results
+        - cache_staleness ~ Number of seconds a cached statistics result may still be used after its server was written to
+        - retention_days ~ Daily logs older than this many days are removed
+        - retention_batch ~ Maximum number of daily logs removed inside a single transaction
+        - retention_pause ~ Number of seconds to wait between two retention transactions
+        - profile ~ Name of the PROFILES pragma profile. With a WAL profile, statistics are read through
+                    a separate read-only connection inside their own thread, so reads and writes don't wait for each other
+        - journal ~ Appends the queued logs to filename.journal.<number> before they are applied to the database, so they
+                    survive a crash and are replayed at the next start. The journal is split into segment files,
+                    the segments whose logs are all in the database are removed after each written batch
+        - journal_sync ~ Number of seconds between two fsyncs of the journal. Every log is written to the operating system
+                         right away, so a killed process loses none, logs of the last interval can only be lost on power loss
+        - trending_half_life ~ Number of seconds after which an emote's trending score is halved (None to disable trending scores).
+                               Scores are kept in memory and persisted by the writer, which decays them from the time of the batch
+        - heatmaps ~ Count the usage per hour of the week (168 packed counters per emote and per server)
+        - pair_limit ~ Count how many times two emotes were used inside the same message, keeping at most
+                       pair_limit most common pairs per server after each retention run (None to disable)
+        - user_days ~ Count the usage per user, keeping daily counts of last user_days days (None to disable)
+        - channels ~ Count the daily usage per channel (kept for retention_days days)
+        - leaderboard_refresh ~ Number of seconds between two recomputations of the global leaderboard in the reader thread (None to disable)
+        - leaderboard_days ~ The global leaderboard is ordered by the count in last leaderboard_days days
+        - leaderboard_size ~ Number of emotes in the global leaderboard
+        - retry_delay ~ Number of seconds before a failed batch is written again, doubled after each failure (up to MAX_RETRY_DELAY).
+                        The batch is retried until it's written, while the queue fills up and producers wait
+        - history_days ~ Prefix sums (statistics between two dates) older than this many days are compacted into a single row per emote,
+                         statistics of date ranges reaching before that are refused (None to keep all of them)"""
+    MAX_RETRY_DELAY = 60
+    "Maximum number of seconds between two attempts to write a failed batch."
+    STOP_ATTEMPTS = 3
+    "Number of attempts to write a failed batch after stop() was called, before the writer gives up."
+
+    def __init__(self, filename, batch_size: int = 500, flush_interval: float = 5, max_pending: int = 10000,
+                 storage: str = "daily", ring_days: int = 30, live_days: int = None,
+                 cache_size: int = 256, cache_staleness: float = 0,
+                 retention_days: int = 30, retention_batch: int = 500, retention_pause: float = 0.1,
+                 profile: str = "default", journal: bool = False, journal_sync: float = 1,
+                 trending_half_life: float = None, heatmaps: bool = False, pair_limit: int = None,
+                 user_days: int = None, channels: bool = False,
+                 leaderboard_refresh: float = None, leaderboard_days: int = 30, leaderboard_size: int = 100,
+                 retry_delay: float = 1, history_days: int = 730) -> None:
         self.engine = None
+        self.read_engine = None
         self.Session = None
+        self.ReadSession = None
         self.filename = filename
+        self.pragmas = PROFILES[profile]
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.queue: asyncio.Queue = None
+        self.writer_task: asyncio.Task = None
+        self.retry_delay = retry_delay
+        self.stopping = False
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sql")
+        self.read_executor = self.executor
+        if str(self.pragmas.get("journal_mode")).upper() == "WAL":
+            self.read_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sql-read")
+
+        if storage == "daily":
+            self.storage = TableStorage()
+        elif storage == "ring":
+            self.storage = RingStorage(ring_days)
+        elif storage == "monthly":
+            self.storage = PartitionedStorage()
+        else:
+            raise ValueError(f"Unknown storage '{storage}'")
+
+        self.counters = counters.LiveCounters(live_days) if live_days is not None else None
+        self.trends = counters.DecayedScores(trending_half_life) if trending_half_life is not None else None
+        self.heatmaps = heatmaps
+        self.pair_limit = pair_limit
+        self.user_days = user_days
+        self.channels = channels
+        self.leaderboard: cache.Leaderboard = None
+        if leaderboard_refresh is not None:
+            self.leaderboard = cache.Leaderboard(
+                lambda: self.global_statistics_async(leaderboard_size, leaderboard_days), leaderboard_refresh
+            )
+        self.statistics_cache = cache.StatisticsCache(cache_size, cache_staleness)
+        self.identities = cache.IdentityCache()
+        self.retention_days = retention_days
+        self.retention_batch = retention_batch
+        self.retention_pause = retention_pause
+        self.history_days = history_days
+        self.journal = journals.Journal(f"{filename}.journal") if journal else None
+        self.journal_sync = journal_sync
     
-    def start(self):
-        self.engine = create_engine(f"sqlite:///{self.filename}", echo=False)
-        sqlBase.metadata.create_all(bind=self.engine)
+    def connect(self):
+        """~ method ~
+        @Info: Opens and migrates the database (without starting the writer and retention tasks, eg. for scripts)"""
+        self.engine = self.create_engine(f"sqlite:///{self.filename}")
+        self.migrate()
         self.Session = sessionmaker(bind=self.engine)
+        self.ReadSession = self.Session
+        if self.read_executor is not self.executor:
+            self.read_engine = self.create_engine(f"sqlite:///file:{self.filename}?mode=ro&uri=true")
+            self.ReadSession = sessionmaker(bind=self.read_engine)
+
+        if self.journal is not None:
+            self.replay()
+
+        if self.counters is not None or self.trends is not None:
+            with self.engine.begin() as connection:
+                if self.counters is not None:
+                    self.load_counters(connection)
+
+                if self.trends is not None:
+                    self.load_trends(connection)
+
+    def create_engine(self, url: str):
+        """~ method ~
+        @Info: Creates an engine whose connections are configured with the profile's pragmas
+        and have the decay(score, elapsed, half_life) function (not every SQLite build has math functions)"""
+        engine = create_engine(url, echo=False)
+
+        @event.listens_for(engine, "connect")
+        def set_pragmas(dbapi_connection, connection_record):
+            dbapi_connection.create_function("decay", 3, counters.decay, deterministic=True)
+            cursor = dbapi_connection.cursor()
+            for name, value in self.pragmas.items():
+                cursor.execute(f"PRAGMA {name} = {value}")
+
+            cursor.close()
+
+        return engine
+
+    def start(self):
+        self.connect()
+        self.queue = asyncio.Queue(maxsize=self.max_pending)
+        self.writer_task = asyncio.create_task(self.writer())
         asyncio.create_task(self.update_history())
+        if self.journal is not None:
+            asyncio.create_task(self.sync_journal())
+
+        if self.leaderboard is not None:
+            asyncio.create_task(self.leaderboard.run())
+
+    def replay(self):
+        """~ method ~
+        @Info: Applies the journaled logs that didn't reach the database (crash) and starts a new journal.
+        Logs up to the sequence number stored in the database were already applied and are skipped.
+        Must run before the in-memory counters are loaded, which then include the replayed logs"""
+        with self.engine.begin() as connection:
+            applied = connection.execute(select(JournalState.seq).where(JournalState.id == 1)).scalar() or 0
+
+        batch = {}
+        collected = 0
+        for seq, *log in self.journal.replay(applied):
+            self.aggregate(batch, *log)
+            applied = seq
+            collected += 1
+            if collected == self.batch_size:
+                self.write_batch(batch, applied)
+                batch = {}
+                collected = 0
+
+        if batch:
+            self.write_batch(batch, applied)
+
+        self.journal.open(applied)
+
+    async def sync_journal(self):
+        """~ coro ~
+        @Info: Makes the journaled logs durable every journal_sync seconds (batched fsync)"""
+        loop = asyncio.get_running_loop()
+        while self.journal.file is not None:
+            await asyncio.sleep(self.journal_sync)
+            if self.journal.file is not None and self.journal.seq != self.journal.synced:
+                await loop.run_in_executor(None, self.journal.sync, self.journal.flush(), self.journal.file)
+
+    def migrate(self):
+        """~ method ~
+        @Info: Creates the schema or upgrades an existing database to the current schema version"""
+        with self.engine.begin() as connection:
+            version = connection.exec_driver_sql("PRAGMA user_version").scalar()
+            if version == 0 and not inspect(connection).has_table(Emote.__tablename__):
+                version = len(MIGRATIONS) # New database, create_all creates the current schema
+
+            sqlBase.metadata.create_all(bind=connection)
+            for number in range(version, len(MIGRATIONS)):
+                MIGRATIONS[number](connection)
+
+            connection.exec_driver_sql(f"PRAGMA user_version = {len(MIGRATIONS)}")
+            self.storage.prepare(connection)
+
+    def load_counters(self, connection: Connection):
+        """~ method ~
+        @Info: Loads the in-memory counters from the database.
+        Daily counts are the differences of the prefix sums, so this works with any daily storage."""
+        today = dt.date.today()
+        cutoff = today - dt.timedelta(days=self.counters.days)
+        self.counters.clear()
+        loaded: Dict[int, Tuple[counters.EmoteCounter, List[int]]] = {}
+        for emote_id, guild_snowflake, snowflake, name, total, base in connection.execute(
+            select(Emote.id, Server.snowflake, Emote.snowflake, Emote.name, Emote.total_count, self.cumulative(Emote.id, cutoff))
+            .join(Server, Server.id == Emote.server_id)
+        ):
+            loaded[emote_id] = (self.counters.insert(guild_snowflake, snowflake, name, total or 0), [base])
+
+        for emote_id, day, total in connection.execute(
+            select(EmoteCumulative.emote_id, EmoteCumulative.day, EmoteCumulative.total)
+            .where(EmoteCumulative.day > cutoff)
+            .order_by(EmoteCumulative.emote_id, EmoteCumulative.day)
+        ):
+            counter, previous = loaded[emote_id]
+            counter.ring.add(day.toordinal(), total - previous[0])
+            previous[0] = total
+
+    def load_trends(self, connection: Connection):
+        """~ method ~
+        @Info: Loads the in-memory trending scores from the database"""
+        self.trends.clear()
+        for guild_snowflake, snowflake, name, score, updated in connection.execute(
+            select(Server.snowflake, Emote.snowflake, Emote.name, EmoteTrend.score, EmoteTrend.updated)
+            .join(Emote, Emote.id == EmoteTrend.emote_id)
+            .join(Server, Server.id == Emote.server_id)
+        ):
+            self.trends.insert(guild_snowflake, snowflake, name, score, updated)
+
+    def preload_guild(self, guild_snowflake: int):
+        """~ method ~
+        @Info: Loads the row ids of the server and all of it's emotes into the identity cache with a single query"""
+        with self.engine.connect() as connection:
+            for server_id, name, emote_id, snowflake, emote_name in connection.execute(
+                select(Server.id, Server.name, Emote.id, Emote.snowflake, Emote.name)
+                .outerjoin(Emote, Emote.server_id == Server.id)
+                .where(Server.snowflake == guild_snowflake)
+            ):
+                self.identities.set_server(guild_snowflake, server_id, name)
+                if emote_id is not None:
+                    self.identities.set_emote(server_id, emote_id, snowflake, emote_name)
+
+    async def preload_guild_async(self, guild_snowflake: int):
+        """~ coro ~
+        @Info: Awaitable version of preload_guild"""
+        await self.run(self.preload_guild, guild_snowflake)
+
+    async def stop(self):
+        """~ coro ~
+        @Info: Writes all the queued logs into the database and stops the writer.
+        A failing batch is attempted at most STOP_ATTEMPTS more times, then the remaining logs are given up
+        (a journal keeps them for the next start)"""
+        self.stopping = True
+        if self.writer_task is not None and not self.writer_task.done():
+            # The queue can stay full when the writer gives up, so don't wait for the put alone
+            put = asyncio.ensure_future(self.queue.put(None))
+            await asyncio.wait({put, self.writer_task}, return_when=asyncio.FIRST_COMPLETED)
+            put.cancel()
+            await self.writer_task
+
+        if self.journal is not None:
+            self.journal.close()
+
+    async def run(self, fnc, *args):
+        """~ coro ~
+        @Info: Runs the synchronous database function inside the database thread"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fnc, *args)
+
+    async def run_read(self, fnc, *args):
+        """~ coro ~
+        @Info: Runs the synchronous read-only database function inside the reader thread"""
+        return await asyncio.get_running_loop().run_in_executor(self.read_executor, fnc, *args)
+
+    async def insert_emote_log_async(self, emotes, guild, user_snowflake: int = None, channel_snowflake: int = None):
+        """~ coro ~
+        @Info: Awaitable version of insert_emote_log (bypasses the log queue).
+        Only the database write runs on the executor, the in-memory counters are updated on the event loop."""
+        now = dt.datetime.now()
+        batch = {}
+        self.aggregate(batch, guild.id, guild.name, now.date(), emotes, counters.hour_of_week(now), user_snowflake, channel_snowflake)
+        await self.run(self.write_batch, batch)
+        self.count_live(guild.id, emotes, now.date())
+
+    async def statistics_async(self, server_snowflake: int, limit: int, day_limit: int, emote_snowflake: int=None, ascending=False,
+                               date_from: dt.date=None, date_to: dt.date=None, channel_snowflake: int=None) -> List[Tuple]:
+        """~ coro ~
+        @Info: Awaitable version of statistics.
+        Answered from the in-memory counters (without the database) when they are enabled and cover day_limit"""
+        if (self.counters is not None and date_from is None and date_to is None and channel_snowflake is None
+            and day_limit <= self.counters.days):
+            return self.counters.statistics(server_snowflake, limit, day_limit, emote_snowflake, ascending)
+
+        return await self.run_read(
+            self.statistics, server_snowflake, limit, day_limit, emote_snowflake, ascending, date_from, date_to, channel_snowflake
+        )
+
+    def trending(self, server_snowflake: int, limit: int) -> List[Tuple]:
+        """~ method ~
+        @Info: Returns (name, snowflake, score) of the server's emotes with the highest trending scores,
+        answered from memory without querying the database"""
+        if self.trends is None:
+            raise ValueError("Trending scores are disabled (trending_half_life)")
+
+        return self.trends.top(server_snowflake, limit, time.time())
+
+    async def clear_old_async(self, days_old: int, limit: int = None) -> int:
+        """~ coro ~
+        @Info: Awaitable version of clear_old"""
+        return await self.run(self.clear_old, days_old, limit)
+
+    async def log_emotes(self, emotes, guild, user_snowflake: int = None, channel_snowflake: int = None):
+        """~ coro ~
+        @Info: Queues the emotes (used by the user inside the channel) for writing into the database and updates the in-memory counters.
+        Waits if the queue is full (database writer is falling behind).
+        The writer checkpoints the counters' increments into the database every flush_interval seconds."""
+        now = dt.datetime.now()
+        day = now.date()
+        hour = counters.hour_of_week(now)
+        item = [None, guild.id, guild.name, day, emotes, hour, user_snowflake, channel_snowflake]
+        await self.queue.put(item)
+        if self.journal is not None:
+            # Appended in the same step as the put, so the journal is in the queue's order
+            item[0] = self.journal.append(guild.id, guild.name, day, emotes, hour, user_snowflake, channel_snowflake)
+
+        self.count_live(guild.id, emotes, day)
+
+    async def writer(self):
+        """~ coro ~
+        @Info: Drains the log queue and writes it into the database
+        when either batch_size logs were collected or flush_interval seconds have passed.
+        A batch that fails is retried (see write_retrying) before any further logs are taken from the queue.
+        After each written batch the journal is rotated and the segments that are all in the database are removed,
+        a batch that was not written is never checkpointed past."""
+        loop = asyncio.get_running_loop()
+        running = True
+        while running:
+            batch = {}
+            collected = 0
+            seq = None
+            deadline = loop.time() + self.flush_interval
+            while collected < self.batch_size:
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+
+                collected += 1
+                if item is None:
+                    running = False
+                    break
+
+                seq = item[0]
+                self.aggregate(batch, *item[1:])
+
+            if batch:
+                if not await self.write_retrying(batch, seq, collected):
+                    print(f"Stopped with {collected + self.queue.qsize()} emote logs not written")
+                    return
+
+                if self.journal is not None:
+                    segment = self.journal.rotate()
+                    if segment is not None:
+                        await loop.run_in_executor(None, self.journal.close_segment, segment)
 
-    def insert_emote_log(self, emotes, guild):
+                    self.journal.checkpoint(seq)
+
+            for _ in range(collected):
+                self.queue.task_done()
+
+    async def write_retrying(self, batch: Dict[Tuple, BatchEntry], seq: int, collected: int) -> bool:
+        """~ coro ~
+        @Info: Writes the batch, retrying it after retry_delay seconds (doubled after each failure) until it's written.
+        The batch stays unchanged and nothing newer is written before it, so a locked or slow database
+        only makes the producers wait. After stop() the batch is attempted at most STOP_ATTEMPTS times.
+        Returns whether the batch was written"""
+        delay = self.retry_delay
+        attempts = 0
+        while True:
+            try:
+                await self.run(self.write_batch, batch, seq)
+                return True
+            except Exception as ex:
+                attempts = attempts + 1 if self.stopping else 0
+                if attempts >= self.STOP_ATTEMPTS:
+                    print(f"Failed to write {collected} emote logs, giving up: {ex}")
+                    return False
+
+                print(f"Failed to write {collected} emote logs, retrying in {delay} seconds: {ex}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.MAX_RETRY_DELAY)
+
+    @staticmethod
+    def aggregate(batch: Dict[Tuple, BatchEntry], guild_snowflake: int, guild_name: str, day: dt.date, emotes: List[Dict],
+                  hour: int = None, user_snowflake: int = None, channel_snowflake: int = None):
+        """~ method ~
+        @Info: Adds the emote logs into the batch, which is keyed by (server snowflake, emote snowflake, day) and has BatchEntry values.
+        Co-occurrence counts are stored with the emote of the pair that has the lower snowflake and are keyed by the other's snowflake"""
+        snowflakes = sorted({emote["snowflake"] for emote in emotes})
+        for emote in emotes:
+            key = (guild_snowflake, emote["snowflake"], day)
+            entry = batch.get(key)
+            if entry is None:
+                entry = batch[key] = BatchEntry(guild_name, emote["name"])
+
+            entry.count += 1
+            if hour is not None:
+                entry.hours[hour] = entry.hours.get(hour, 0) + 1
+
+            if user_snowflake is not None:
+                entry.users[user_snowflake] = entry.users.get(user_snowflake, 0) + 1
+
+            if channel_snowflake is not None:
+                entry.channels[channel_snowflake] = entry.channels.get(channel_snowflake, 0) + 1
+
+        # Emotes used together inside the same message
+        for index, first in enumerate(snowflakes[:-1]):
+            partners = batch[(guild_snowflake, first, day)].partners
+            for second in snowflakes[index + 1:]:
+                partners[second] = partners.get(second, 0) + 1
+
+    def insert_emote_log(self, emotes, guild, user_snowflake: int = None, channel_snowflake: int = None):
+        """~ method ~
+        @Info: Writes the emote logs into the database immediately (synchronous path, eg. for scripts).
+        Updates the in-memory counters too, so it must not be called from another thread while the bot is running,
+        use insert_emote_log_async there instead."""
+        batch = {}
+        now = dt.datetime.now()
+        day = now.date()
+        self.aggregate(batch, guild.id, guild.name, day, emotes, counters.hour_of_week(now), user_snowflake, channel_snowflake)
+        self.write_batch(batch)
+        self.count_live(guild.id, emotes, day)
+
+    def count_live(self, guild_snowflake: int, emotes, day: dt.date):
+        """~ method ~
+        @Info: Adds the emote usages to the in-memory counters and trending scores.
+        Called on the event loop only, their readers are not thread safe"""
+        if self.counters is not None:
+            self.counters.add(guild_snowflake, emotes, day)
+
+        if self.trends is not None:
+            self.trends.add(guild_snowflake, emotes, time.time())
+
+    def write_batch(self, batch: Dict[Tuple, BatchEntry], seq: int = None):
+        """~ method ~
+        @Info: Writes aggregated emote logs into the database inside a single transaction.
+        seq is the sequence number of the last journaled log in the batch, it's stored inside the same transaction"""
+        try:
+            self.write(batch, seq)
+            self.storage.committed()
+        except Exception:
+            # The transaction was rolled back, resynchronize storage's state (eg. created partitions) with the database
+            # and forget the rows ids that might have been rolled back.
+            self.identities.clear()
+            with self.engine.begin() as connection:
+                self.storage.prepare(connection)
+
+            raise
+
+    UPSERT_SERVER = text(
+        "INSERT INTO Server (name, snowflake) VALUES (:name, :snowflake) "
+        "ON CONFLICT (snowflake) DO UPDATE SET name = excluded.name RETURNING id"
+    )
+    UPSERT_CUMULATIVE = text(
+        "INSERT INTO EmoteCumulative (emote_id, day, total) VALUES (:emote_id, :day, :count + coalesce("
+        "(SELECT total FROM EmoteCumulative WHERE emote_id = :emote_id AND day < :day ORDER BY day DESC LIMIT 1), 0)) "
+        "ON CONFLICT (emote_id, day) DO UPDATE SET total = total + :count"
+    ).bindparams(bindparam("day", type_=Date))
+    SHIFT_CUMULATIVE = text(
+        "UPDATE EmoteCumulative SET total = total + :count WHERE emote_id = :emote_id AND day > :day"
+    ).bindparams(bindparam("day", type_=Date))
+    COMPACT_CUMULATIVE = text(
+        "INSERT INTO EmoteCumulative (emote_id, day, total) "
+        "SELECT emote_id, :base, max(total) FROM EmoteCumulative WHERE day > :base AND day <= :cutoff GROUP BY emote_id "
+        "ON CONFLICT (emote_id, day) DO UPDATE SET total = excluded.total"
+    ).bindparams(bindparam("base", type_=Date), bindparam("cutoff", type_=Date))
+    DELETE_CUMULATIVE = text(
+        "DELETE FROM EmoteCumulative WHERE day > :base AND day <= :cutoff"
+    ).bindparams(bindparam("base", type_=Date), bindparam("cutoff", type_=Date))
+    SELECT_EMOTE = text("SELECT id FROM Emote WHERE server_id = :server_id AND (name = :name OR snowflake = :snowflake) LIMIT 1")
+    INSERT_EMOTE = text(
+        "INSERT INTO Emote (name, snowflake, server_id, total_count, last_used) VALUES (:name, :snowflake, :server_id, :count, :day) RETURNING id"
+    ).bindparams(bindparam("day", type_=Date))
+    UPDATE_EMOTE = text(
+        "UPDATE Emote SET name = :name, snowflake = :snowflake, total_count = total_count + :count, "
+        "last_used = max(coalesce(last_used, :day), :day) WHERE id = :id"
+    ).bindparams(bindparam("day", type_=Date))
+    INCREASE_EMOTE = text(
+        "UPDATE Emote SET total_count = total_count + :count, last_used = max(coalesce(last_used, :day), :day) WHERE id = :id"
+    ).bindparams(bindparam("day", type_=Date))
+    UPSERT_TREND = text(
+        "INSERT INTO EmoteTrend (emote_id, score, updated) VALUES (:emote_id, :count, :now) "
+        "ON CONFLICT (emote_id) DO UPDATE SET score = decay(score, :now - updated, :half_life) + :count, updated = :now"
+    )
+    SELECT_EMOTE_HEATMAP = text("SELECT counts FROM EmoteHeatmap WHERE emote_id = :id")
+    UPSERT_EMOTE_HEATMAP = text(
+        "INSERT INTO EmoteHeatmap (emote_id, counts) VALUES (:id, :counts) ON CONFLICT (emote_id) DO UPDATE SET counts = excluded.counts"
+    )
+    SELECT_SERVER_HEATMAP = text("SELECT counts FROM ServerHeatmap WHERE server_id = :id")
+    UPSERT_SERVER_HEATMAP = text(
+        "INSERT INTO ServerHeatmap (server_id, counts) VALUES (:id, :counts) ON CONFLICT (server_id) DO UPDATE SET counts = excluded.counts"
+    )
+    UPSERT_PAIR = text(
+        "INSERT INTO EmotePair (server_id, first_snowflake, second_snowflake, count) VALUES (:server_id, :first, :second, :count) "
+        "ON CONFLICT (server_id, first_snowflake, second_snowflake) DO UPDATE SET count = count + excluded.count"
+    )
+    UPSERT_USER_EMOTE = text(
+        "INSERT INTO UserEmote (user_snowflake, emote_id, day, count) VALUES (:user, :emote_id, :day, :count) "
+        "ON CONFLICT (user_snowflake, emote_id, day) DO UPDATE SET count = count + excluded.count"
+    )
+    UPSERT_CHANNEL_EMOTE = text(
+        "INSERT INTO ChannelEmote (channel_snowflake, day, emote_id, count) VALUES (:channel, :day, :emote_id, :count) "
+        "ON CONFLICT (channel_snowflake, day, emote_id) DO UPDATE SET count = count + excluded.count"
+    )
+    UPSERT_JOURNAL = text("INSERT INTO JournalState (id, seq) VALUES (1, :seq) ON CONFLICT (id) DO UPDATE SET seq = excluded.seq")
+    # Statements of the write path are prebuilt plain SQL, building and caching (SQLAlchemy can't cache ON CONFLICT)
+    # SQLAlchemy statements for every row costs several times more than executing them
+
+    def write(self, batch: Dict[Tuple, BatchEntry], seq: int = None):
         session: Session
         with self.Session.begin() as session:
-            for emote in emotes:
+            connection = session.connection()
+            servers: Dict[int, int] = {}
+            identities = self.identities
+            now = time.time()
+            server_hours: Dict[int, Dict[int, int]] = {}
+            for (guild_snowflake, emote_snowflake, day), entry in batch.items():
+                guild_name, name, count = entry.guild_name, entry.name, entry.count
                 # Add to Server table
-                qserver: Server = session.query(Server).where(Server.snowflake == guild.id).first() # Server query
-                if qserver is None:
-                    qserver = Server(guild.name, guild.id)
-                    session.add(qserver)
-                    session.flush()
-
-                # Add if it doesn't exists
-                qemote: Emote = session.query(Emote).where(and_(or_(Emote.name == emote["name"], Emote.snowflake == emote["snowflake"]), Emote.server_id == qserver.id)).first() # Emote query
-                if qemote is None:
-                    qemote = Emote(emote["name"], emote["snowflake"], qserver.id)
-                    session.add(qemote)
-                    session.flush()
-                else:
+                server_id = servers.get(guild_snowflake)
+                if server_id is None:
+                    server = identities.server(guild_snowflake)
+                    if server is None or server[1] != guild_name:
+                        server_id = connection.execute(self.UPSERT_SERVER, {"name": guild_name, "snowflake": guild_snowflake}).scalar_one()
+                        identities.set_server(guild_snowflake, server_id, guild_name)
+                    else:
+                        server_id = server[0]
+
+                    servers[guild_snowflake] = server_id
+
+                # Add if it doesn't exists (emotes with the same name are replaced)
+                parameters = {"name": name, "snowflake": emote_snowflake, "server_id": server_id, "count": count, "day": day}
+                emote_id = identities.emote(server_id, emote_snowflake, name)
+                if emote_id is None:
+                    emote_id = connection.execute(self.SELECT_EMOTE, parameters).scalar()
+
+                if emote_id is None:
+                    emote_id = connection.execute(self.INSERT_EMOTE, parameters).scalar_one()
+                elif identities.identity(emote_id) == (server_id, emote_snowflake, name):
                     # Increase total count
-                    qemote.name = emote["name"]
-                    qemote.snowflake = emote["snowflake"]
-                    qemote.total_count += 1
+                    connection.execute(self.INCREASE_EMOTE, {"id": emote_id, "count": count, "day": day})
+                else:
+                    # Increase total count and replace the snowflake / name
+                    connection.execute(self.UPDATE_EMOTE, {**parameters, "id": emote_id})
+
+                identities.set_emote(server_id, emote_id, emote_snowflake, name)
 
                 # Increase daily counts
-                qemote_daily: EmoteDaily = session.query(EmoteDaily).where(EmoteDaily.emote_id == qemote.id, EmoteDaily.timestamp == dt.datetime.now().date()).first()
-                if qemote_daily is None:
-                    qemote_daily = EmoteDaily(qemote.id)
-                    session.add(qemote_daily)
-                else:
-                    qemote_daily.count += 1
-              
+                self.storage.add(connection, emote_id, day, count)
+                self.add_cumulative(connection, emote_id, day, count)
+                if self.trends is not None:
+                    connection.execute(self.UPSERT_TREND, {"emote_id": emote_id, "count": count, "now": now, "half_life": self.trends.half_life})
+
+                if self.heatmaps and entry.hours:
+                    self.add_heatmap(connection, self.SELECT_EMOTE_HEATMAP, self.UPSERT_EMOTE_HEATMAP, emote_id, entry.hours)
+                    totals = server_hours.setdefault(server_id, {})
+                    for hour, hour_count in entry.hours.items():
+                        totals[hour] = totals.get(hour, 0) + hour_count
+
+                if self.user_days is not None:
+                    for user_snowflake, user_count in entry.users.items():
+                        connection.execute(
+                            self.UPSERT_USER_EMOTE, {"user": user_snowflake, "emote_id": emote_id, "day": day.toordinal(), "count": user_count}
+                        )
+
+                if self.channels:
+                    for channel_snowflake, channel_count in entry.channels.items():
+                        connection.execute(
+                            self.UPSERT_CHANNEL_EMOTE,
+                            {"channel": channel_snowflake, "day": day.toordinal(), "emote_id": emote_id, "count": channel_count}
+                        )
+
+                if self.pair_limit is not None:
+                    for partner, pair_count in entry.partners.items():
+                        connection.execute(self.UPSERT_PAIR, {"server_id": server_id, "first": emote_snowflake, "second": partner, "count": pair_count})
+
+            for server_id, hours in server_hours.items():
+                self.add_heatmap(connection, self.SELECT_SERVER_HEATMAP, self.UPSERT_SERVER_HEATMAP, server_id, hours)
 
-    def statistics(self, server_snowflake: int, limit: int, day_limit: int, emote_snowflake: int=None, ascending=False) -> List[Tuple]:
+            if seq is not None:
+                connection.execute(self.UPSERT_JOURNAL, {"seq": seq})
+
+        for guild_snowflake in servers:
+            self.statistics_cache.invalidate(guild_snowflake)
+
+    @classmethod
+    def add_cumulative(cls, connection: Connection, emote_id: int, day: dt.date, count: int):
+        """~ method ~
+        @Info: Increases the emote's cumulative (prefix sum) counts from day onwards"""
+        parameters = {"emote_id": emote_id, "day": day, "count": count}
+        connection.execute(cls.UPSERT_CUMULATIVE, parameters)
+        # Logs for a past day (eg. written after midnight) also shift the later prefix sums
+        if day < dt.date.today():
+            connection.execute(cls.SHIFT_CUMULATIVE, parameters)
+
+    @staticmethod
+    def add_heatmap(connection: Connection, select_statement, upsert_statement, row_id: int, hours: Dict[int, int]):
+        """~ method ~
+        @Info: Increases the hour of the week counts of a heatmap row (emote's or server's)"""
+        counts = connection.execute(select_statement, {"id": row_id}).scalar()
+        heatmap = counters.unpack_heatmap(counts)
+        for hour, count in hours.items():
+            heatmap[hour] += count
+
+        connection.execute(upsert_statement, {"id": row_id, "counts": heatmap.tobytes()})
+
+    def heatmap(self, server_snowflake: int, emote_snowflake: int = None) -> List[int]:
+        """~ method ~
+        @Info: Returns the 168 (7 days * 24 hours, starting with Monday 00:00) usage counts of the server
+        or only of it's emote, read from a single row"""
         session: Session
-        with self.Session.begin() as session:
-            server: Server = session.query(Server).where(Server.snowflake == server_snowflake).first()
-            if server is not None:
-                conditions = [Emote.server_id == server.id, (dt.datetime.now() - EmoteDaily.timestamp) < day_limit]
-                if emote_snowflake is not None:
-                    conditions.append(Emote.snowflake == emote_snowflake)
-
-                ret = (
-                    session.query(Emote.name, Emote.snowflake, Emote.total_count, func.sum(EmoteDaily.count).label("count30day"))
-                    .join(EmoteDaily, EmoteDaily.emote_id == Emote.id)
-                    .where(*conditions)
-                    .group_by(EmoteDaily.emote_id)
-                    .order_by(text(f"count30day {'ASC' if ascending else 'DESC'}"))
-                    .limit(limit)
+        with self.ReadSession() as session:
+            if emote_snowflake is None:
+                statement = (
+                    select(ServerHeatmap.counts)
+                    .join(Server, Server.id == ServerHeatmap.server_id)
+                    .where(Server.snowflake == server_snowflake)
+                )
+            else:
+                statement = (
+                    select(EmoteHeatmap.counts)
+                    .join(Emote, Emote.id == EmoteHeatmap.emote_id)
+                    .join(Server, Server.id == Emote.server_id)
+                    .where(Server.snowflake == server_snowflake, Emote.snowflake == emote_snowflake)
                 )
-                all_ = ret.all()
-                if all_ is not None:
-                    return all_
-        
-        return []
+
+            return counters.unpack_heatmap(session.execute(statement).scalar()).tolist()
+
+    async def heatmap_async(self, server_snowflake: int, emote_snowflake: int = None) -> List[int]:
+        """~ coro ~
+        @Info: Awaitable version of heatmap"""
+        return await self.run_read(self.heatmap, server_snowflake, emote_snowflake)
+
+    @staticmethod
+    def cumulative(emote_id, day: dt.date):
+        """~ method ~
+        @Info: Returns a scalar subquery of the emote's cumulative count at the end of day"""
+        return func.coalesce(
+            select(EmoteCumulative.total)
+            .where(EmoteCumulative.emote_id == emote_id, EmoteCumulative.day <= day)
+            .order_by(EmoteCumulative.day.desc())
+            .limit(1)
+            .scalar_subquery(),
+            0
+        )
+
+    def statistics(self, server_snowflake: int, limit: int, day_limit: int, emote_snowflake: int=None, ascending=False,
+                   date_from: dt.date=None, date_to: dt.date=None, channel_snowflake: int=None) -> List[Tuple]:
+        """~ method ~
+        @Info: Returns (name, snowflake, total count, count in last day_limit days) of the server's emotes,
+        ordered by the count in last day_limit days.
+        If date_from and/or date_to are given, the count between those two days (inclusive) is returned instead.
+        If channel_snowflake is given, only the usage inside that channel is counted (the total count stays server-wide).
+        Results are cached until the server is written to.
+        Raises ValueError if date_from or date_to is before history_start (the counts would be wrong)."""
+        start = self.history_start()
+        if start is not None and ((date_from is not None and date_from < start) or (date_to is not None and date_to < start - dt.timedelta(days=1))):
+            raise ValueError(f"Usage between two dates is only kept since {start}!")
+
+        key = (server_snowflake, limit, day_limit, emote_snowflake, ascending, date_from, date_to, channel_snowflake, dt.date.today())
+        ret = self.statistics_cache.get(key)
+        if ret is not None:
+            return ret
+
+        generation = self.statistics_cache.generation(server_snowflake) # Before reading, the reader may see an older snapshot
+        ret = []
+        session: Session
+        with self.ReadSession.begin() as session:
+            server_id = session.execute(select(Server.id).where(Server.snowflake == server_snowflake)).scalar()
+            if server_id is not None:
+                if channel_snowflake is not None:
+                    ret = self.channel_statistics(session, server_id, limit, day_limit, emote_snowflake, ascending, date_from, date_to, channel_snowflake)
+                elif date_from is not None or date_to is not None:
+                    ret = self.range_statistics(session, server_id, limit, emote_snowflake, ascending, date_from, date_to)
+                else:
+                    ret = self.storage.statistics(session, server_id, limit, day_limit, emote_snowflake, ascending)
+
+        self.statistics_cache.put(key, ret, generation)
+        return ret
+
+    def range_statistics(self, session: Session, server_id: int, limit: int, emote_snowflake: int, ascending: bool,
+                         date_from: dt.date, date_to: dt.date) -> List[Tuple]:
+        """~ method ~
+        @Info: Returns (name, snowflake, total count, count between date_from and date_to) of the server's emotes.
+        The count of each emote is a difference of two prefix sums (two index lookups), no daily rows are scanned."""
+        count = self.cumulative(Emote.id, date_to or dt.date.today())
+        if date_from is not None:
+            count = count - self.cumulative(Emote.id, date_from - dt.timedelta(days=1))
+
+        conditions = [Emote.server_id == server_id]
+        if emote_snowflake is not None:
+            conditions.append(Emote.snowflake == emote_snowflake)
+
+        counts = select(Emote.name, Emote.snowflake, Emote.total_count, count.label("count")).where(*conditions).subquery()
+        return session.execute(
+            select(counts)
+            .where(counts.c.count > 0)
+            .order_by(counts.c.count.asc() if ascending else counts.c.count.desc())
+            .limit(limit)
+        ).all()
+
+    def channel_statistics(self, session: Session, server_id: int, limit: int, day_limit: int, emote_snowflake: int, ascending: bool,
+                           date_from: dt.date, date_to: dt.date, channel_snowflake: int) -> List[Tuple]:
+        """~ method ~
+        @Info: Returns (name, snowflake, total count, count inside the channel) of the server's emotes,
+        counted in last day_limit days or between date_from and date_to (only the last retention_days days are kept).
+        Reads a single range of the channel's daily rollups (primary key)"""
+        if date_from is None and date_to is None:
+            date_from = dt.date.today() - dt.timedelta(days=day_limit - 1)
+
+        conditions = [ChannelEmote.channel_snowflake == channel_snowflake, Emote.server_id == server_id]
+        if date_from is not None:
+            conditions.append(ChannelEmote.day >= date_from.toordinal())
+
+        if date_to is not None:
+            conditions.append(ChannelEmote.day <= date_to.toordinal())
+
+        if emote_snowflake is not None:
+            conditions.append(Emote.snowflake == emote_snowflake)
+
+        count = func.sum(ChannelEmote.count).label("count")
+        return session.execute(
+            select(Emote.name, Emote.snowflake, Emote.total_count, count)
+            .join(Emote, Emote.id == ChannelEmote.emote_id)
+            .where(*conditions)
+            .group_by(ChannelEmote.emote_id)
+            .order_by(count.asc() if ascending else count.desc())
+            .limit(limit)
+        ).all()
+
+    def global_statistics(self, limit: int, day_limit: int, ascending=False) -> List[Tuple]:
+        """~ method ~
+        @Info: Returns (name, snowflake, total count, count in last day_limit days) of emotes across all the servers
+        in the database, ordered by the count in last day_limit days.
+        Counts come from the prefix sums, so this works with any daily storage."""
+        today = dt.date.today()
+        count = self.cumulative(Emote.id, today) - self.cumulative(Emote.id, today - dt.timedelta(days=day_limit))
+        counts = select(Emote.name, Emote.snowflake, Emote.total_count, count.label("count")).subquery()
+        window = func.sum(counts.c.count)
+        with self.ReadSession.begin() as session:
+            session: Session
+            return session.execute(
+                select(func.max(counts.c.name), counts.c.snowflake, func.sum(counts.c.total_count), window)
+                .group_by(counts.c.snowflake)
+                .having(window > 0)
+                .order_by(window.asc() if ascending else window.desc())
+                .limit(limit)
+            ).all()
+
+    async def global_statistics_async(self, limit: int, day_limit: int, ascending=False) -> List[Tuple]:
+        """~ coro ~
+        @Info: Awaitable version of global_statistics"""
+        return await self.run_read(self.global_statistics, limit, day_limit, ascending)
+
+    def global_leaderboard(self, limit: int) -> List[Tuple]:
+        """~ method ~
+        @Info: Returns (name, snowflake, total count, count in last leaderboard_days days) of the most used emotes
+        across all the servers, from the periodically recomputed global statistics (no database query)"""
+        if self.leaderboard is None:
+            raise ValueError("The global leaderboard is disabled (leaderboard_refresh)")
+
+        return self.leaderboard.top(limit)
 
     async def update_history(self):
         """~ coro ~ 
-        @Info: Used for clearing daily logs that are older than days"""
+        @Info: Removes daily logs that are older than retention_days in small batches, yielding between them,
+        and compacts the prefix sums that are older than history_days.
+        Runs right after start (catching up on anything missed while the bot was not running) and then after every midnight."""
         while True:
+            while await self.run(self.clear_old, self.retention_days, self.retention_batch) == self.retention_batch:
+                await asyncio.sleep(self.retention_pause)
+
+            if self.history_days is not None:
+                await self.run(self.compact_cumulative, self.history_days)
+
+            if self.pair_limit is not None:
+                await self.run(self.prune_pairs, self.pair_limit)
+
+            if self.user_days is not None:
+                await self.run(self.clear_old_users, self.user_days)
+
+            if self.channels:
+                await self.run(self.clear_old_channels, self.retention_days)
+
             current = dt.datetime.now()
             next = (current + dt.timedelta(days=1)).replace(hour=0, minute=0, second=1)
             await asyncio.sleep( (next-current).total_seconds() ) # Sleeps until midnight
-            self.clear_old(30)
 
-    def clear_old(self, days_old: int):
+    def clear_old(self, days_old: int, limit: int = None) -> int:
         """~ method ~
-        @Info: Removes history that is older than days_old
+        @Info: Removes history that is older than days_old.
+        If limit is given, at most limit rows are removed. Returns the number of removed rows.
         """
         with self.Session.begin() as session:
             session: Session
-            session.execute(
-                text(
-                    f"""
-                    DELETE FROM EmoteDaily
-                    WHERE CAST(julianday() - julianday(timestamp) AS real) >= {days_old};
-                    """
-                )
+            return self.storage.clear_old(session, days_old, limit)
+
+    def history_start(self) -> dt.date:
+        """~ method ~
+        @Info: Returns the first day that statistics between two dates can start at (prefix sums before it may be compacted),
+        None if the prefix sums are never compacted"""
+        if self.history_days is None:
+            return None
+
+        days_old = max(self.history_days, self.counters.days) if self.counters is not None else self.history_days
+        return dt.date.today() - dt.timedelta(days=days_old - 1)
+
+    def compact_cumulative(self, days_old: int) -> int:
+        """~ method ~
+        @Info: Moves the prefix sums that are older than days_old (or than the live counters' days) into the CUMULATIVE_BASE row of each emote,
+        so every emote keeps at most days_old + 1 rows. Returns the number of removed rows.
+        Prefix sums are non-decreasing, so the newest compacted total is the largest one"""
+        if self.counters is not None:
+            days_old = max(days_old, self.counters.days)
+
+        parameters = {"base": CUMULATIVE_BASE, "cutoff": dt.date.today() - dt.timedelta(days=days_old)}
+        with self.engine.begin() as connection:
+            connection.execute(self.COMPACT_CUMULATIVE, parameters)
+            return connection.execute(self.DELETE_CUMULATIVE, parameters).rowcount
+
+    def clear_old_users(self, days_old: int) -> int:
+        """~ method ~
+        @Info: Removes per user counts that are older than days_old, one transaction per emote
+        (deletes by the emote and day index). Returns the number of removed rows"""
+        cutoff = (dt.date.today() - dt.timedelta(days=days_old)).toordinal()
+        with self.engine.connect() as connection:
+            emote_ids = connection.execute(select(Emote.id)).scalars().all()
+
+        removed = 0
+        for emote_id in emote_ids:
+            with self.engine.begin() as connection:
+                removed += connection.execute(
+                    delete(UserEmote).where(UserEmote.emote_id == emote_id, UserEmote.day <= cutoff)
+                ).rowcount
+
+        return removed
+
+    def unused_emotes(self, server_snowflake: int, emote_snowflakes: List[int], days: int) -> List[Tuple[int, dt.date]]:
+        """~ method ~
+        @Info: Returns (snowflake, last used day) of the emote_snowflakes (eg. the server's current emojis)
+        that were not used in last days days, never used emotes (last used day is None) first and then the longest unused.
+        Emotes last used before the tracked days (before the upgrade to last_used) have CUMULATIVE_BASE as their last used day.
+        A single query through the (server_id, snowflake) index"""
+        cutoff = dt.date.today() - dt.timedelta(days=days)
+        session: Session
+        with self.ReadSession() as session:
+            last_used = dict(
+                session.execute(
+                    select(Emote.snowflake, Emote.last_used)
+                    .join(Server, Server.id == Emote.server_id)
+                    .where(Server.snowflake == server_snowflake, Emote.snowflake.in_(emote_snowflakes))
+                ).all()
             )
+
+        unused = [
+            (snowflake, last_used.get(snowflake)) for snowflake in emote_snowflakes
+            if last_used.get(snowflake) is None or last_used[snowflake] <= cutoff
+        ]
+        unused.sort(key=lambda row: (row[1] is not None, row[1] or dt.date.min))
+        return unused
+
+    async def unused_emotes_async(self, server_snowflake: int, emote_snowflakes: List[int], days: int) -> List[Tuple[int, dt.date]]:
+        """~ coro ~
+        @Info: Awaitable version of unused_emotes"""
+        return await self.run_read(self.unused_emotes, server_snowflake, emote_snowflakes, days)
+
+    def clear_old_channels(self, days_old: int) -> int:
+        """~ method ~
+        @Info: Removes per channel counts that are older than days_old, one transaction per channel
+        (deletes by the primary key). Returns the number of removed rows"""
+        cutoff = (dt.date.today() - dt.timedelta(days=days_old)).toordinal()
+        with self.engine.connect() as connection:
+            channels = connection.execute(select(ChannelEmote.channel_snowflake).distinct()).scalars().all()
+
+        removed = 0
+        for channel_snowflake in channels:
+            with self.engine.begin() as connection:
+                removed += connection.execute(
+                    delete(ChannelEmote).where(ChannelEmote.channel_snowflake == channel_snowflake, ChannelEmote.day <= cutoff)
+                ).rowcount
+
+        return removed
+
+    def user_statistics(self, server_snowflake: int, user_snowflake: int, limit: int, day_limit: int) -> List[Tuple]:
+        """~ method ~
+        @Info: Returns (name, snowflake, count) of the emotes the user used most inside the server in last day_limit days"""
+        cutoff = (dt.date.today() - dt.timedelta(days=day_limit)).toordinal()
+        count = func.sum(UserEmote.count).label("count")
+        session: Session
+        with self.ReadSession() as session:
+            return [
+                tuple(row) for row in session.execute(
+                    select(Emote.name, Emote.snowflake, count)
+                    .join(Emote, Emote.id == UserEmote.emote_id)
+                    .join(Server, Server.id == Emote.server_id)
+                    .where(UserEmote.user_snowflake == user_snowflake, UserEmote.day > cutoff, Server.snowflake == server_snowflake)
+                    .group_by(UserEmote.emote_id)
+                    .order_by(count.desc())
+                    .limit(limit)
+                )
+            ]
+
+    async def user_statistics_async(self, server_snowflake: int, user_snowflake: int, limit: int, day_limit: int) -> List[Tuple]:
+        """~ coro ~
+        @Info: Awaitable version of user_statistics"""
+        return await self.run_read(self.user_statistics, server_snowflake, user_snowflake, limit, day_limit)
+
+    def emote_users(self, server_snowflake: int, emote_snowflake: int, limit: int, day_limit: int) -> List[Tuple]:
+        """~ method ~
+        @Info: Returns (user snowflake, count) of the users that used the server's emote most in last day_limit days"""
+        cutoff = (dt.date.today() - dt.timedelta(days=day_limit)).toordinal()
+        count = func.sum(UserEmote.count).label("count")
+        emote_id = (
+            select(Emote.id)
+            .join(Server, Server.id == Emote.server_id)
+            .where(Server.snowflake == server_snowflake, Emote.snowflake == emote_snowflake)
+            .scalar_subquery()
+        )
+        session: Session
+        with self.ReadSession() as session:
+            return [
+                tuple(row) for row in session.execute(
+                    select(UserEmote.user_snowflake, count)
+                    .where(UserEmote.emote_id == emote_id, UserEmote.day > cutoff)
+                    .group_by(UserEmote.user_snowflake)
+                    .order_by(count.desc())
+                    .limit(limit)
+                )
+            ]
+
+    async def emote_users_async(self, server_snowflake: int, emote_snowflake: int, limit: int, day_limit: int) -> List[Tuple]:
+        """~ coro ~
+        @Info: Awaitable version of emote_users"""
+        return await self.run_read(self.emote_users, server_snowflake, emote_snowflake, limit, day_limit)
+
+    def prune_pairs(self, pair_limit: int) -> int:
+        """~ method ~
+        @Info: Removes the least common co-occurring emote pairs of every server that has more than pair_limit pairs.
+        Returns the number of removed pairs"""
+        ranked = select(
+            EmotePair.server_id, EmotePair.first_snowflake, EmotePair.second_snowflake,
+            func.row_number().over(partition_by=EmotePair.server_id, order_by=EmotePair.count.desc()).label("rank")
+        ).subquery()
+        with self.Session.begin() as session:
+            session: Session
+            return session.execute(
+                delete(EmotePair)
+                .where(
+                    tuple_(EmotePair.server_id, EmotePair.first_snowflake, EmotePair.second_snowflake).in_(
+                        select(ranked.c.server_id, ranked.c.first_snowflake, ranked.c.second_snowflake).where(ranked.c.rank > pair_limit)
+                    )
+                )
+            ).rowcount
+
+    def partners(self, server_snowflake: int, emote_snowflake: int, limit: int) -> List[Tuple]:
+        """~ method ~
+        @Info: Returns (name, snowflake, count) of the emotes most often used inside the same message as the server's emote.
+        Name is None if the partner emote was never used on it's own"""
+        server_id = select(Server.id).where(Server.snowflake == server_snowflake).scalar_subquery()
+        pairs = union_all(
+            select(EmotePair.second_snowflake.label("snowflake"), EmotePair.count)
+            .where(EmotePair.server_id == server_id, EmotePair.first_snowflake == emote_snowflake),
+            select(EmotePair.first_snowflake.label("snowflake"), EmotePair.count)
+            .where(EmotePair.server_id == server_id, EmotePair.second_snowflake == emote_snowflake)
+        ).subquery()
+        session: Session
+        with self.ReadSession() as session:
+            return [
+                tuple(row) for row in session.execute(
+                    select(Emote.name, pairs.c.snowflake, pairs.c.count)
+                    .outerjoin(Emote, (Emote.server_id == server_id) & (Emote.snowflake == pairs.c.snowflake))
+                    .order_by(pairs.c.count.desc())
+                    .limit(limit)
+                )
+            ]
+
+    async def partners_async(self, server_snowflake: int, emote_snowflake: int, limit: int) -> List[Tuple]:
+        """~ coro ~
+        @Info: Awaitable version of partners"""
+        return await self.run_read(self.partners, server_snowflake, emote_snowflake, limit)
     
 
+class ShardedManager:
+    """~ class ~
+    @Info: Splits the servers across shards SQLite databases (hash partitioned by server snowflake),
+    each managed by it's own Manager with it's own writer and database thread, so writes to different shards run in parallel.
+    Has the same interface as Manager, global_statistics queries all the shards.
+    An existing database can be split with split_database (split_db.py).
+    @Param:
+        - filename_pattern ~ Path pattern of the database files, {} is replaced with the shard number
+        - shards ~ Number of shards
+        - kwargs ~ Manager parameters, the global leaderboard is computed over all the shards (in parallel)"""
+    def __init__(self, filename_pattern: str, shards: int, **kwargs) -> None:
+        leaderboard_refresh = kwargs.pop("leaderboard_refresh", None)
+        leaderboard_days = kwargs.pop("leaderboard_days", 30)
+        leaderboard_size = kwargs.pop("leaderboard_size", 100)
+        self.shards = [Manager(filename_pattern.format(number), **kwargs) for number in range(shards)]
+        self.leaderboard: cache.Leaderboard = None
+        if leaderboard_refresh is not None:
+            self.leaderboard = cache.Leaderboard(
+                lambda: self.global_statistics_async(leaderboard_size, leaderboard_days), leaderboard_refresh
+            )
+
+    def shard(self, server_snowflake: int) -> Manager:
+        """~ method ~
+        @Info: Returns the manager of the server's shard"""
+        return self.shards[shard_number(server_snowflake, len(self.shards))]
+
+    def connect(self):
+        for shard in self.shards:
+            shard.connect()
+
+    def start(self):
+        for shard in self.shards:
+            shard.start()
+
+        if self.leaderboard is not None:
+            asyncio.create_task(self.leaderboard.run())
+
+    async def stop(self):
+        await asyncio.gather(*(shard.stop() for shard in self.shards))
+
+    async def log_emotes(self, emotes, guild, user_snowflake: int = None, channel_snowflake: int = None):
+        await self.shard(guild.id).log_emotes(emotes, guild, user_snowflake, channel_snowflake)
+
+    def preload_guild(self, guild_snowflake: int):
+        self.shard(guild_snowflake).preload_guild(guild_snowflake)
+
+    async def preload_guild_async(self, guild_snowflake: int):
+        await self.shard(guild_snowflake).preload_guild_async(guild_snowflake)
+
+    def insert_emote_log(self, emotes, guild, user_snowflake: int = None, channel_snowflake: int = None):
+        self.shard(guild.id).insert_emote_log(emotes, guild, user_snowflake, channel_snowflake)
+
+    async def insert_emote_log_async(self, emotes, guild, user_snowflake: int = None, channel_snowflake: int = None):
+        await self.shard(guild.id).insert_emote_log_async(emotes, guild, user_snowflake, channel_snowflake)
+
+    def statistics(self, server_snowflake: int, *args, **kwargs) -> List[Tuple]:
+        return self.shard(server_snowflake).statistics(server_snowflake, *args, **kwargs)
+
+    async def statistics_async(self, server_snowflake: int, *args, **kwargs) -> List[Tuple]:
+        return await self.shard(server_snowflake).statistics_async(server_snowflake, *args, **kwargs)
+
+    def heatmap(self, server_snowflake: int, emote_snowflake: int = None) -> List[int]:
+        return self.shard(server_snowflake).heatmap(server_snowflake, emote_snowflake)
+
+    async def heatmap_async(self, server_snowflake: int, emote_snowflake: int = None) -> List[int]:
+        return await self.shard(server_snowflake).heatmap_async(server_snowflake, emote_snowflake)
+
+    def partners(self, server_snowflake: int, emote_snowflake: int, limit: int) -> List[Tuple]:
+        return self.shard(server_snowflake).partners(server_snowflake, emote_snowflake, limit)
+
+    async def partners_async(self, server_snowflake: int, emote_snowflake: int, limit: int) -> List[Tuple]:
+        return await self.shard(server_snowflake).partners_async(server_snowflake, emote_snowflake, limit)
+
+    def user_statistics(self, server_snowflake: int, user_snowflake: int, limit: int, day_limit: int) -> List[Tuple]:
+        return self.shard(server_snowflake).user_statistics(server_snowflake, user_snowflake, limit, day_limit)
+
+    async def user_statistics_async(self, server_snowflake: int, user_snowflake: int, limit: int, day_limit: int) -> List[Tuple]:
+        return await self.shard(server_snowflake).user_statistics_async(server_snowflake, user_snowflake, limit, day_limit)
+
+    def emote_users(self, server_snowflake: int, emote_snowflake: int, limit: int, day_limit: int) -> List[Tuple]:
+        return self.shard(server_snowflake).emote_users(server_snowflake, emote_snowflake, limit, day_limit)
+
+    async def emote_users_async(self, server_snowflake: int, emote_snowflake: int, limit: int, day_limit: int) -> List[Tuple]:
+        return await self.shard(server_snowflake).emote_users_async(server_snowflake, emote_snowflake, limit, day_limit)
+
+    def unused_emotes(self, server_snowflake: int, emote_snowflakes: List[int], days: int) -> List[Tuple[int, dt.date]]:
+        return self.shard(server_snowflake).unused_emotes(server_snowflake, emote_snowflakes, days)
+
+    async def unused_emotes_async(self, server_snowflake: int, emote_snowflakes: List[int], days: int) -> List[Tuple[int, dt.date]]:
+        return await self.shard(server_snowflake).unused_emotes_async(server_snowflake, emote_snowflakes, days)
+
+    def clear_old_channels(self, days_old: int) -> int:
+        return sum(shard.clear_old_channels(days_old) for shard in self.shards)
+
+    def clear_old_users(self, days_old: int) -> int:
+        return sum(shard.clear_old_users(days_old) for shard in self.shards)
+
+    def compact_cumulative(self, days_old: int) -> int:
+        return sum(shard.compact_cumulative(days_old) for shard in self.shards)
+
+    def prune_pairs(self, pair_limit: int) -> int:
+        return sum(shard.prune_pairs(pair_limit) for shard in self.shards)
+
+    def trending(self, server_snowflake: int, limit: int) -> List[Tuple]:
+        return self.shard(server_snowflake).trending(server_snowflake, limit)
+
+    def clear_old(self, days_old: int, limit: int = None) -> int:
+        return sum(shard.clear_old(days_old, limit) for shard in self.shards)
+
+    async def clear_old_async(self, days_old: int, limit: int = None) -> int:
+        return sum(await asyncio.gather(*(shard.clear_old_async(days_old, limit) for shard in self.shards)))
+
+    def global_statistics(self, limit: int, day_limit: int, ascending=False) -> List[Tuple]:
+        return self.merge_global([shard.global_statistics(limit, day_limit, ascending) for shard in self.shards], limit, ascending)
+
+    async def global_statistics_async(self, limit: int, day_limit: int, ascending=False) -> List[Tuple]:
+        """~ coro ~
+        @Info: Queries all the shards in parallel (each inside it's own database thread) and merges the results"""
+        results = await asyncio.gather(*(shard.global_statistics_async(limit, day_limit, ascending) for shard in self.shards))
+        return self.merge_global(results, limit, ascending)
+
+    def global_leaderboard(self, limit: int) -> List[Tuple]:
+        if self.leaderboard is None:
+            raise ValueError("The global leaderboard is disabled (leaderboard_refresh)")
+
+        return self.leaderboard.top(limit)
+
+    @staticmethod
+    def merge_global(results: List[List[Tuple]], limit: int, ascending: bool) -> List[Tuple]:
+        """~ method ~
+        @Info: Merges the shards' global statistics.
+        All the logs of a server are in a single shard, so every shard's top limit emotes are enough."""
+        merged: Dict[int, List] = {}
+        for result in results:
+            for name, snowflake, total_count, count in result:
+                row = merged.get(snowflake)
+                if row is None:
+                    merged[snowflake] = [name, snowflake, total_count, count]
+                else:
+                    row[2] += total_count
+                    row[3] += count
+
+        select_ = heapq.nsmallest if ascending else heapq.nlargest
+        return [tuple(row) for row in select_(limit, merged.values(), key=lambda row: row[3])]
+
+
+def shard_number(server_snowflake: int, shards: int) -> int:
+    """~ function ~
+    @Info: Returns the number of the shard the server belongs to.
+    The snowflake's timestamp bits are mixed into the low bits (worker, process and increment), which alone are poorly distributed"""
+    return ((server_snowflake >> 22) ^ server_snowflake) % shards
+
+
+def split_database(filename: str, filename_pattern: str, shards: int):
+    """~ function ~
+    @Info: Splits an existing database into shards databases used by ShardedManager.
+    Every table that references emotes or servers (daily counts, rings, prefix sums, partitions, heatmaps, ...) is copied
+    together with the servers and emotes of the shard. Row ids are kept.
+    The database is migrated and it's journal replayed first. Raises ValueError if a shard file already has data."""
+    for number in range(shards):
+        shard_filename = filename_pattern.format(number)
+        if os.path.exists(shard_filename) and os.path.getsize(shard_filename) > 0:
+            raise ValueError(f"Shard {shard_filename} already exists")
+
+    manager = Manager(filename, journal=True)
+    manager.connect()
+    manager.journal.close()
+    manager.engine.dispose()
+
+    server_columns = ", ".join(column.name for column in Server.__table__.columns)
+    emote_columns = ", ".join(column.name for column in Emote.__table__.columns)
+    for number in range(shards):
+        shard_filename = filename_pattern.format(number)
+        manager = Manager(shard_filename)
+        manager.connect()
+        manager.engine.dispose()
+
+        connection = sqlite3.connect(shard_filename)
+        connection.create_function("shard_number", 2, shard_number, deterministic=True)
+        try:
+            connection.execute("ATTACH DATABASE ? AS source", (filename,))
+            with connection:
+                connection.execute(
+                    f"INSERT INTO main.Server ({server_columns}) SELECT {server_columns} FROM source.Server "
+                    "WHERE shard_number(snowflake, ?) = ?", (shards, number)
+                )
+                connection.execute(
+                    f"INSERT INTO main.Emote ({emote_columns}) SELECT {emote_columns} FROM source.Emote "
+                    "WHERE server_id IN (SELECT id FROM main.Server)"
+                )
+                for table, sql in connection.execute(
+                    "SELECT name, sql FROM source.sqlite_master WHERE type = 'table' AND name NOT IN ('Server', 'Emote')"
+                ).fetchall():
+                    columns = [row[1] for row in connection.execute(f'PRAGMA source.table_info("{table}")')]
+                    if "emote_id" in columns:
+                        condition = "emote_id IN (SELECT id FROM main.Emote)"
+                    elif "server_id" in columns:
+                        condition = "server_id IN (SELECT id FROM main.Server)"
+                    else:
+                        continue
+
+                    if connection.execute("SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is None:
+                        connection.execute(sql) # Eg. a monthly partition
+
+                    columns = ", ".join(f'"{column}"' for column in columns)
+                    connection.execute(
+                        f'INSERT INTO main."{table}" ({columns}) SELECT {columns} FROM source."{table}" WHERE {condition}'
+                    )
+        finally:
+            connection.close()
+
+
+class TableStorage:
+    """~ class ~
+    @Info: Stores daily counts as one EmoteDaily row per emote per day"""
+    UPSERT = text(
+        "INSERT INTO EmoteDaily (emote_id, timestamp, count) VALUES (:emote_id, :day, :count) "
+        "ON CONFLICT (emote_id, timestamp) DO UPDATE SET count = count + excluded.count"
+    ).bindparams(bindparam("day", type_=Date))
+
+    def prepare(self, connection: Connection):
+        """~ method ~
+        @Info: Called once the schema is up to date"""
+
+    def committed(self):
+        """~ method ~
+        @Info: Called after a write transaction committed"""
+
+    def add(self, connection: Connection, emote_id: int, day: dt.date, count: int):
+        """~ method ~
+        @Info: Increases the emote's count for the day"""
+        connection.execute(self.UPSERT, {"emote_id": emote_id, "day": day, "count": count})
+
+    def statistics(self, session: Session, server_id: int, limit: int, day_limit: int, emote_snowflake: int, ascending: bool) -> List[Tuple]:
+        """~ method ~
+        @Info: Returns (name, snowflake, total count, count in last day_limit days) of the server's emotes"""
+        conditions = [Emote.server_id == server_id, EmoteDaily.timestamp > dt.date.today() - dt.timedelta(days=day_limit)]
+        if emote_snowflake is not None:
+            conditions.append(Emote.snowflake == emote_snowflake)
+
+        return (
+            session.query(Emote.name, Emote.snowflake, Emote.total_count, func.sum(EmoteDaily.count).label("count30day"))
+            .join(EmoteDaily, EmoteDaily.emote_id == Emote.id)
+            .where(*conditions)
+            .group_by(EmoteDaily.emote_id)
+            .order_by(text(f"count30day {'ASC' if ascending else 'DESC'}"))
+            .limit(limit)
+            .all()
+        )
+
+    def clear_old(self, session: Session, days_old: int, limit: int = None) -> int:
+        """~ method ~
+        @Info: Removes (at most limit) rows that are older than days_old, returns the number of removed rows"""
+        condition = EmoteDaily.timestamp <= dt.date.today() - dt.timedelta(days=days_old)
+        if limit is not None:
+            # Uses the timestamp index to pick the batch
+            condition = text("rowid IN (SELECT rowid FROM EmoteDaily WHERE timestamp <= :cutoff LIMIT :limit)").bindparams(
+                cutoff=dt.date.today() - dt.timedelta(days=days_old),
+                limit=limit
+            )
+
+        return session.execute(delete(EmoteDaily).where(condition)).rowcount
+
+
+class RingStorage:
+    """~ class ~
+    @Info: Stores daily counts of each emote inside a fixed-size array (EmoteRing.counts) of days slots (counters.DayRing).
+    Slots of days that are skipped get zeroed when the array rotates, so no rows ever need to be deleted."""
+    UPSERT = text(
+        "INSERT INTO EmoteRing (emote_id, day, counts) VALUES (:emote_id, :day, :counts) "
+        "ON CONFLICT (emote_id) DO UPDATE SET day = excluded.day, counts = excluded.counts"
+    )
+
+    SELECT = text("SELECT day, counts FROM EmoteRing WHERE emote_id = :emote_id")
+
+    def __init__(self, days: int) -> None:
+        self.days = days
+
+    def committed(self):
+        """~ method ~
+        @Info: Called after a write transaction committed"""
+
+    def prepare(self, connection: Connection):
+        """~ method ~
+        @Info: Fills the ring arrays from EmoteDaily rows when switching an existing database to the ring storage"""
+        if connection.execute(select(EmoteRing.emote_id).limit(1)).first() is not None:
+            return
+
+        today = dt.date.today().toordinal()
+        rings: Dict[int, counters.DayRing] = {}
+        for emote_id, day, count in connection.execute(
+            select(EmoteDaily.emote_id, EmoteDaily.timestamp, EmoteDaily.count)
+            .where(EmoteDaily.timestamp > dt.date.today() - dt.timedelta(days=self.days))
+        ):
+            ring = rings.get(emote_id)
+            if ring is None:
+                ring = rings[emote_id] = counters.DayRing(self.days, today)
+
+            ring.add(day.toordinal(), count)
+
+        if rings:
+            connection.execute(
+                insert(EmoteRing),
+                [{"emote_id": emote_id, "day": ring.day, "counts": ring.to_bytes()} for emote_id, ring in rings.items()]
+            )
+
+    def add(self, connection: Connection, emote_id: int, day: dt.date, count: int):
+        """~ method ~
+        @Info: Increases the emote's count for the day"""
+        day = day.toordinal()
+        row = connection.execute(self.SELECT, {"emote_id": emote_id}).first()
+        ring = counters.DayRing(self.days, day) if row is None else counters.DayRing.from_bytes(self.days, *row)
+        if not ring.add(day, count): # Too old to be stored
+            return
+
+        connection.execute(self.UPSERT, {"emote_id": emote_id, "day": ring.day, "counts": ring.to_bytes()})
+
+    def statistics(self, session: Session, server_id: int, limit: int, day_limit: int, emote_snowflake: int, ascending: bool) -> List[Tuple]:
+        """~ method ~
+        @Info: Returns (name, snowflake, total count, count in last day_limit days) of the server's emotes"""
+        conditions = [Emote.server_id == server_id]
+        if emote_snowflake is not None:
+            conditions.append(Emote.snowflake == emote_snowflake)
+
+        today = dt.date.today().toordinal()
+        ret = []
+        for name, snowflake, total_count, last, counts in session.execute(
+            select(Emote.name, Emote.snowflake, Emote.total_count, EmoteRing.day, EmoteRing.counts)
+            .join(EmoteRing, EmoteRing.emote_id == Emote.id)
+            .where(*conditions)
+        ):
+            count = counters.DayRing.from_bytes(self.days, last, counts).window(day_limit, today)
+            if count:
+                ret.append((name, snowflake, total_count, count))
+
+        ret.sort(key=lambda row: row[3], reverse=not ascending)
+        return ret[:limit]
+
+    def clear_old(self, session: Session, days_old: int, limit: int = None) -> int:
+        """~ method ~
+        @Info: Nothing to remove, old days are overwritten when the ring rotates"""
+        return 0
+
+
+class PartitionedStorage:
+    """~ class ~
+    @Info: Stores daily counts as rows of monthly partition tables (EmoteDaily_YYYYMM).
+    Statistics only read the partitions that overlap the requested window,
+    retention drops whole partitions instead of deleting rows (freed pages are reused by new partitions).
+    Partitions created by the writer are only published to the readers (another thread and connection with WAL)
+    once their transaction committed, partitions is always replaced, never modified in place."""
+    NAME_PATTERN = re.compile(r"^EmoteDaily_(\d{4})(\d{2})$")
+
+    def __init__(self) -> None:
+        self.metadata = MetaData()
+        self.partitions: Dict[Tuple[int, int], Table] = {} #: Committed partitions, keys are (year, month)
+        self.created: Dict[Tuple[int, int], Table] = {} #: Partitions created inside the ongoing write transaction
+        self.upserts: Dict[str, text] = {} #: Keys are partition names
+
+    def partition(self, year: int, month: int) -> Table:
+        """~ method ~
+        @Info: Returns the table descriptor of the month's partition"""
+        name = f"EmoteDaily_{year:04d}{month:02d}"
+        table = self.metadata.tables.get(name)
+        if table is None:
+            table = Table(
+                name,
+                self.metadata,
+                Column("emote_id", Integer, ForeignKey(Emote.id)),
+                Column("timestamp", Date),
+                Column("count", Integer),
+                PrimaryKeyConstraint("emote_id", "timestamp"),
+            )
+
+        return table
+
+    def window(self, first: dt.date, last: dt.date) -> List[Table]:
+        """~ method ~
+        @Info: Returns existing partitions that overlap days between first and last"""
+        return [
+            table for (year, month), table in self.partitions.items() # Replaced (not modified) by the writer thread
+            if (first.year, first.month) <= (year, month) <= (last.year, last.month)
+        ]
+
+    def prepare(self, connection: Connection):
+        """~ method ~
+        @Info: Discovers existing partitions, or moves EmoteDaily rows into partitions
+        when switching an existing database to the monthly storage (before the readers start)"""
+        partitions = {}
+        for name in inspect(connection).get_table_names():
+            match = self.NAME_PATTERN.match(name)
+            if match is not None:
+                partitions[(int(match.group(1)), int(match.group(2)))] = self.partition(int(match.group(1)), int(match.group(2)))
+
+        self.created = {}
+        if not partitions:
+            rows: Dict[Tuple[int, int], List[Dict]] = {}
+            for emote_id, day, count in connection.execute(select(EmoteDaily.emote_id, EmoteDaily.timestamp, EmoteDaily.count)):
+                rows.setdefault((day.year, day.month), []).append({"emote_id": emote_id, "timestamp": day, "count": count})
+
+            for (year, month), values in rows.items():
+                table = partitions[(year, month)] = self.partition(year, month)
+                table.create(bind=connection, checkfirst=True)
+                connection.execute(insert(table), values)
+
+            connection.execute(delete(EmoteDaily))
+
+        self.partitions = partitions
+
+    def committed(self):
+        """~ method ~
+        @Info: Publishes the partitions created by the committed write transaction to the readers"""
+        if self.created:
+            self.partitions = {**self.partitions, **self.created}
+            self.created = {}
+
+    def add(self, connection: Connection, emote_id: int, day: dt.date, count: int):
+        """~ method ~
+        @Info: Increases the emote's count for the day"""
+        key = (day.year, day.month)
+        table = self.partitions.get(key) or self.created.get(key)
+        if table is None:
+            table = self.created[key] = self.partition(day.year, day.month)
+            table.create(bind=connection, checkfirst=True)
+
+        upsert = self.upserts.get(table.name)
+        if upsert is None:
+            upsert = self.upserts[table.name] = text(
+                f'INSERT INTO "{table.name}" (emote_id, timestamp, count) VALUES (:emote_id, :day, :count) '
+                "ON CONFLICT (emote_id, timestamp) DO UPDATE SET count = count + excluded.count"
+            ).bindparams(bindparam("day", type_=Date))
+
+        connection.execute(upsert, {"emote_id": emote_id, "day": day, "count": count})
+
+    def statistics(self, session: Session, server_id: int, limit: int, day_limit: int, emote_snowflake: int, ascending: bool) -> List[Tuple]:
+        """~ method ~
+        @Info: Returns (name, snowflake, total count, count in last day_limit days) of the server's emotes"""
+        today = dt.date.today()
+        cutoff = today - dt.timedelta(days=day_limit)
+        tables = self.window(cutoff + dt.timedelta(days=1), today)
+        if not tables:
+            return []
+
+        daily = union_all(
+            *(select(table.c.emote_id, table.c.count).where(table.c.timestamp > cutoff) for table in tables)
+        ).subquery()
+        conditions = [Emote.server_id == server_id]
+        if emote_snowflake is not None:
+            conditions.append(Emote.snowflake == emote_snowflake)
+
+        return session.execute(
+            select(Emote.name, Emote.snowflake, Emote.total_count, func.sum(daily.c.count).label("count30day"))
+            .join(daily, daily.c.emote_id == Emote.id)
+            .where(*conditions)
+            .group_by(daily.c.emote_id)
+            .order_by(literal_column("count30day").asc() if ascending else literal_column("count30day").desc())
+            .limit(limit)
+        ).all()
+
+    def clear_old(self, session: Session, days_old: int, limit: int = None) -> int:
+        """~ method ~
+        @Info: Drops (at most limit) partitions whose days are all older than days_old, returns the number of dropped partitions.
+        Old rows of the partition that is only partially expired are excluded by the statistics window."""
+        cutoff = dt.date.today() - dt.timedelta(days=days_old)
+        if (cutoff + dt.timedelta(days=1)).month != cutoff.month: # The cutoff is the last day of it's month
+            cutoff += dt.timedelta(days=1)
+
+        expired = [key for key in sorted(self.partitions) if key < (cutoff.year, cutoff.month)]
+
+        # Unpublished before the drop commits, readers stop using them first
+        self.partitions = {key: table for key, table in self.partitions.items() if key not in expired[:limit]}
+        for key in expired[:limit]:
+            table = self.partition(*key)
+            table.drop(bind=session.connection(), checkfirst=True)
+
+        return len(expired[:limit])
+
+
 class Emote(sqlBase):
     """~ table descriptor class ~
     @Info: Used for tracking all the emotes in the server"""
     __tablename__ = "Emote"
-    __table_args__= (UniqueConstraint("snowflake", "server_id"),)
+    __table_args__= (
+        UniqueConstraint("snowflake", "server_id"),
+        Index("ix_Emote_server_snowflake", "server_id", "snowflake"),
+        Index("ix_Emote_server_name", "server_id", "name"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String)
     snowflake = Column(BigInteger)
     server_id = Column(Integer, ForeignKey("Server.id"))
     total_count = Column(BigInteger)
+    last_used = Column(Date) # Last day the emote was used
 
     def __init__(self, name, snowflake, server_id):
         self.name = name
@@ -137,6 +1589,10 @@ class EmoteDaily(sqlBase):
     """~ table descriptor class ~
     @Info: Used for tracking daily usages"""
     __tablename__ = "EmoteDaily"
+    __table_args__ = (
+        Index("ix_EmoteDaily_timestamp", "timestamp"),
+        Index("ix_EmoteDaily_emote_timestamp_count", "emote_id", "timestamp", "count"), # Covers the statistics query
+    )
     emote_id  = Column(Integer, ForeignKey("Emote.id"), primary_key=True)
     count     = Column(Integer)
     timestamp = Column(Date, primary_key=True)
@@ -146,6 +1602,102 @@ class EmoteDaily(sqlBase):
         self.timestamp = dt.datetime.now().date()
         self.count = 1
 
+class EmoteRing(sqlBase):
+    """~ table descriptor class ~
+    @Info: Used for tracking daily usages inside a fixed-size array of daily counts (RingStorage)"""
+    __tablename__ = "EmoteRing"
+    emote_id = Column(Integer, ForeignKey("Emote.id"), primary_key=True)
+    day      = Column(Integer) # Ordinal of the last written day
+    counts   = Column(LargeBinary) # Packed array of unsigned 32 bit daily counts
+
+
+class EmoteCumulative(sqlBase):
+    """~ table descriptor class ~
+    @Info: Used for tracking cumulative (prefix sum) usages, total is the emote's count up to and including day.
+    The count between two days is the difference of two rows"""
+    __tablename__ = "EmoteCumulative"
+    emote_id = Column(Integer, ForeignKey("Emote.id"), primary_key=True)
+    day      = Column(Date, primary_key=True)
+    total    = Column(BigInteger)
+
+
+class EmoteHeatmap(sqlBase):
+    """~ table descriptor class ~
+    @Info: Used for tracking usages per hour of the week"""
+    __tablename__ = "EmoteHeatmap"
+    emote_id = Column(Integer, ForeignKey("Emote.id"), primary_key=True)
+    counts   = Column(LargeBinary) # Packed array of 168 unsigned 32 bit counts, starting with Monday 00:00
+
+
+class ServerHeatmap(sqlBase):
+    """~ table descriptor class ~
+    @Info: Used for tracking usages of all the server's emotes per hour of the week"""
+    __tablename__ = "ServerHeatmap"
+    server_id = Column(Integer, ForeignKey("Server.id"), primary_key=True)
+    counts    = Column(LargeBinary) # Packed array of 168 unsigned 32 bit counts, starting with Monday 00:00
+
+
+class ChannelEmote(sqlBase):
+    """~ table descriptor class ~
+    @Info: Used for tracking daily usages per channel (the emote determines the server).
+    The primary key covers the channel statistics and the retention"""
+    __tablename__ = "ChannelEmote"
+    __table_args__ = (
+        {"sqlite_with_rowid": False},
+    )
+    channel_snowflake = Column(BigInteger, primary_key=True)
+    day               = Column(Integer, primary_key=True) # Ordinal of the day
+    emote_id          = Column(Integer, ForeignKey("Emote.id"), primary_key=True)
+    count             = Column(Integer)
+
+
+class UserEmote(sqlBase):
+    """~ table descriptor class ~
+    @Info: Used for tracking daily usages per user (the emote determines the server).
+    The primary key covers the per user queries, the index the per emote queries and the retention"""
+    __tablename__ = "UserEmote"
+    __table_args__ = (
+        Index("ix_UserEmote_emote_day_user_count", "emote_id", "day", "user_snowflake", "count"),
+        {"sqlite_with_rowid": False},
+    )
+    user_snowflake = Column(BigInteger, primary_key=True)
+    emote_id       = Column(Integer, ForeignKey("Emote.id"), primary_key=True)
+    day            = Column(Integer, primary_key=True) # Ordinal of the day
+    count          = Column(Integer)
+
+
+class EmotePair(sqlBase):
+    """~ table descriptor class ~
+    @Info: Used for tracking how many times two emotes were used inside the same message.
+    Each pair is stored once, first_snowflake is the lower snowflake"""
+    __tablename__ = "EmotePair"
+    __table_args__ = (
+        Index("ix_EmotePair_server_second", "server_id", "second_snowflake"), # The primary key covers the first_snowflake lookups
+        {"sqlite_with_rowid": False},
+    )
+    server_id        = Column(Integer, ForeignKey("Server.id"), primary_key=True)
+    first_snowflake  = Column(BigInteger, primary_key=True)
+    second_snowflake = Column(BigInteger, primary_key=True)
+    count            = Column(Integer)
+
+
+class EmoteTrend(sqlBase):
+    """~ table descriptor class ~
+    @Info: Used for persisting the exponentially decayed trending scores, score is the value at the updated timestamp"""
+    __tablename__ = "EmoteTrend"
+    emote_id = Column(Integer, ForeignKey("Emote.id"), primary_key=True)
+    score    = Column(Float)
+    updated  = Column(Float)
+
+
+class JournalState(sqlBase):
+    """~ table descriptor class ~
+    @Info: Used for tracking the sequence number of the last journaled log applied to the database (single row)"""
+    __tablename__ = "JournalState"
+    id  = Column(Integer, primary_key=True)
+    seq = Column(BigInteger)
+
+
 class Server(sqlBase):
     """~ table descriptor class ~
     @Info: Used for tracking all the servers"""
@@ -157,3 +1709,52 @@ class Server(sqlBase):
     def __init__(self, name, snowflake) -> None:
         self.name = name
         self.snowflake = snowflake
+
+
+# Migrations, append only!
+@migration
+def add_indexes(connection: Connection):
+    """~ migration 1 ~
+    @Info: Indexes for the emote lookups, statistics window and retention"""
+    for table in (Emote.__table__, EmoteDaily.__table__):
+        for index in table.indexes:
+            index.create(bind=connection, checkfirst=True)
+
+
+@migration
+def fill_cumulative(connection: Connection):
+    """~ migration 2 ~
+    @Info: Fills the prefix sums from the existing daily counts.
+    Usage from before the oldest daily row is accounted for at CUMULATIVE_BASE, outside of every queried window."""
+    daily: Dict[int, List[Tuple[dt.date, int]]] = {}
+    for emote_id, day, count in connection.execute(
+        select(EmoteDaily.emote_id, EmoteDaily.timestamp, EmoteDaily.count).order_by(EmoteDaily.emote_id, EmoteDaily.timestamp)
+    ):
+        daily.setdefault(emote_id, []).append((day, count))
+
+    rows = []
+    for emote_id, total_count in connection.execute(select(Emote.id, Emote.total_count)):
+        days = daily.get(emote_id, [])
+        running = (total_count or 0) - sum(count for _, count in days)
+        rows.append({"emote_id": emote_id, "day": CUMULATIVE_BASE, "total": running})
+        for day, count in days:
+            running += count
+            rows.append({"emote_id": emote_id, "day": day, "total": running})
+
+    if rows:
+        connection.execute(insert(EmoteCumulative), rows)
+
+
+@migration
+def add_last_used(connection: Connection):
+    """~ migration 3 ~
+    @Info: Adds the day of the last use to the emotes, filled from the last day with a prefix sum increase.
+    Emotes used only before the tracked days get CUMULATIVE_BASE (used, but longer ago than any tracked day)"""
+    connection.exec_driver_sql("ALTER TABLE Emote ADD COLUMN last_used DATE")
+    connection.execute(
+        text(
+            "UPDATE Emote SET last_used = coalesce(("
+            "SELECT max(day) FROM (SELECT day, total - lag(total, 1, 0) OVER (ORDER BY day) AS count FROM EmoteCumulative "
+            "WHERE emote_id = Emote.id) WHERE count > 0 AND day > :base), CASE WHEN total_count > 0 THEN :base END)"
+        ).bindparams(bindparam("base", CUMULATIVE_BASE, type_=Date))
+    )
@@ -0,0 +1,315 @@
+import asyncio
+import datetime as dt
+import sqlite3
+import types
+
+import pytest
+
+import journal
+import sql
+
+
+def create_baseline(filename: str, total_count: int, daily: dict):
+    """~ function ~
+    @Info: Creates a database with the schema from before the migrations (user_version 0)"""
+    connection = sqlite3.connect(filename)
+    connection.executescript(
+        "CREATE TABLE Server (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR, snowflake BIGINT UNIQUE);"
+        "CREATE TABLE Emote (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR, snowflake BIGINT, "
+        "server_id INTEGER REFERENCES Server (id), total_count BIGINT);"
+        "CREATE TABLE EmoteDaily (emote_id INTEGER REFERENCES Emote (id), count INTEGER, timestamp DATE, "
+        "PRIMARY KEY (emote_id, timestamp));"
+        "INSERT INTO Server (name, snowflake) VALUES ('guild', 10);"
+    )
+    connection.execute("INSERT INTO Emote (name, snowflake, server_id, total_count) VALUES ('emote', 20, 1, ?)", (total_count,))
+    connection.executemany(
+        "INSERT INTO EmoteDaily (emote_id, count, timestamp) VALUES (1, ?, ?)", [(count, day.isoformat()) for day, count in daily.items()]
+    )
+    connection.commit()
+    connection.close()
+
+
+def test_upgrade_keeps_history_out_of_windows(tmp_path):
+    """Usage from before the daily rows must not show up in any window after the prefix sums are filled"""
+    filename = str(tmp_path / "emotes.db")
+    today = dt.date.today()
+    create_baseline(filename, 50, {today - dt.timedelta(days=5): 1})
+
+    manager = sql.Manager(filename, live_days=30)
+    manager.connect()
+    try:
+        expected = [("emote", 20, 50, 1)]
+        assert manager.statistics(10, 10, 30) == expected
+        assert manager.counters.statistics(10, 10, 30) == expected
+        assert manager.statistics(10, 10, 30, date_from=today - dt.timedelta(days=29)) == expected
+        assert manager.global_statistics(10, 30) == expected
+        assert asyncio.run(manager.statistics_async(10, 10, 30)) == expected
+    finally:
+        manager.engine.dispose()
+
+
+def test_upgrade_fills_last_used(tmp_path):
+    """The last used day comes from the tracked days, older usage is marked with CUMULATIVE_BASE"""
+    filename = str(tmp_path / "emotes.db")
+    today = dt.date.today()
+    create_baseline(filename, 50, {today - dt.timedelta(days=60): 1})
+    connection = sqlite3.connect(filename)
+    connection.executemany(
+        "INSERT INTO Emote (name, snowflake, server_id, total_count) VALUES (?, ?, 1, ?)", [("old", 21, 7), ("new", 22, 0)]
+    )
+    connection.commit()
+    connection.close()
+
+    manager = sql.Manager(filename)
+    manager.connect()
+    try:
+        assert manager.unused_emotes(10, [20, 21, 22, 23], 30) == [
+            (22, None), (23, None), (21, sql.CUMULATIVE_BASE), (20, today - dt.timedelta(days=60))
+        ]
+    finally:
+        manager.engine.dispose()
+
+
+def test_writer_retries_failed_batch(tmp_path):
+    """A batch that fails to be written is retried, while producers wait for the full queue"""
+    guild = types.SimpleNamespace(id=10, name="guild")
+    manager = sql.Manager(str(tmp_path / "emotes.db"), batch_size=2, flush_interval=0.01, max_pending=2, retry_delay=0.01)
+    write_batch = manager.write_batch
+    failures = [sqlite3.OperationalError("database is locked")] * 3
+
+    def failing_write_batch(*args):
+        if failures:
+            raise failures.pop()
+
+        write_batch(*args)
+
+    manager.write_batch = failing_write_batch
+
+    async def log():
+        manager.start()
+        for _ in range(10):
+            await manager.log_emotes([{"name": "emote", "snowflake": 20}], guild)
+
+        await manager.stop()
+
+    asyncio.run(log())
+    try:
+        assert not failures
+        assert manager.statistics(10, 10, 30) == [("emote", 20, 10, 10)]
+    finally:
+        manager.engine.dispose()
+
+    # A database that keeps failing with a full queue, stop() gives up instead of waiting for the queue
+    manager = sql.Manager(str(tmp_path / "failing.db"), batch_size=2, flush_interval=0.01, max_pending=2, retry_delay=0.01)
+
+    def always_failing_write_batch(*args):
+        raise sqlite3.OperationalError("database is locked")
+
+    manager.write_batch = always_failing_write_batch
+
+    async def log_failing():
+        manager.start()
+        producer = asyncio.create_task(log_many())
+        await asyncio.sleep(0.1)
+        assert manager.queue.full()
+        await asyncio.wait_for(manager.stop(), 5)
+        assert manager.writer_task.done()
+        producer.cancel()
+
+    async def log_many():
+        for _ in range(10):
+            await manager.log_emotes([{"name": "emote", "snowflake": 20}], guild)
+
+    asyncio.run(log_failing())
+    manager.engine.dispose()
+
+
+def test_journal_removes_applied_segments(tmp_path):
+    """Under steady load (the writer never catches up) the applied journal segments are still removed"""
+    guild = types.SimpleNamespace(id=10, name="guild")
+    manager = sql.Manager(str(tmp_path / "emotes.db"), batch_size=5, flush_interval=0.01, journal=True)
+
+    async def log():
+        manager.start()
+        for _ in range(200):
+            await manager.log_emotes([{"name": "emote", "snowflake": 20}], guild)
+            await asyncio.sleep(0.001)
+            assert len(manager.journal.numbers()) <= 3
+
+        await manager.stop()
+
+    asyncio.run(log())
+    try:
+        assert manager.statistics(10, 10, 30) == [("emote", 20, 200, 200)]
+    finally:
+        manager.engine.dispose()
+
+
+def test_journal_keeps_unwritten_batches(tmp_path):
+    """Logs of a batch the writer gave up on are replayed at the next start, none are skipped or doubled"""
+    filename = str(tmp_path / "emotes.db")
+    guild = types.SimpleNamespace(id=10, name="guild")
+    manager = sql.Manager(filename, batch_size=2, flush_interval=0.01, journal=True, retry_delay=0.01)
+    write_batch = manager.write_batch
+
+    def failing_write_batch(batch, seq=None):
+        if seq > 4:
+            raise sqlite3.OperationalError("disk I/O error")
+
+        write_batch(batch, seq)
+
+    manager.write_batch = failing_write_batch
+
+    async def log(manager: sql.Manager):
+        manager.start()
+        for _ in range(9):
+            await manager.log_emotes([{"name": "emote", "snowflake": 20}], guild)
+
+        await manager.stop()
+
+    asyncio.run(log(manager))
+    manager.engine.dispose()
+    manager = sql.Manager(filename, journal=True)
+    manager.connect()
+    try:
+        assert manager.statistics(10, 10, 30) == [("emote", 20, 9, 9)]
+    finally:
+        manager.journal.close()
+        manager.engine.dispose()
+
+
+def test_compact_cumulative_keeps_windows(tmp_path):
+    """Prefix sums older than the compacted days are folded into one row per emote without changing the recent counts"""
+    filename = str(tmp_path / "emotes.db")
+    today = dt.date.today()
+    create_baseline(filename, 50, {today - dt.timedelta(days=days): days for days in (1, 5, 40, 60)})
+
+    manager = sql.Manager(filename, live_days=30, retention_days=30)
+    manager.connect()
+    try:
+        window = today - dt.timedelta(days=29)
+        assert manager.compact_cumulative(30) == 2
+        assert manager.compact_cumulative(30) == 0
+        with manager.engine.connect() as connection:
+            assert connection.execute(sql.select(sql.func.count()).select_from(sql.EmoteCumulative)).scalar() == 3
+
+        assert manager.statistics(10, 10, 30, date_from=window) == [("emote", 20, 50, 6)]
+        assert manager.global_statistics(10, 30) == [("emote", 20, 50, 6)]
+        with manager.engine.connect() as connection:
+            manager.load_counters(connection)
+
+        assert manager.counters.statistics(10, 10, 30) == [("emote", 20, 50, 6)]
+    finally:
+        manager.engine.dispose()
+
+
+def test_journal_survives_killed_process(tmp_path):
+    """Journaled logs reach the operating system right away, without waiting for the batched sync"""
+    filename = str(tmp_path / "emotes.db")
+    guild = types.SimpleNamespace(id=10, name="guild")
+    manager = sql.Manager(filename, flush_interval=100, journal=True, journal_sync=100)
+
+    async def log():
+        manager.start()
+        for _ in range(5):
+            await manager.log_emotes([{"name": "emote", "snowflake": 20}], guild)
+
+        with open(manager.journal.path(manager.journal.number), encoding="utf-8") as file:
+            return file.read().count("\n")
+
+    assert asyncio.run(log()) == 5
+    manager.journal.file.close() # Killed without stop()
+    manager.engine.dispose()
+    replayed = sql.Manager(filename, journal=True)
+    replayed.connect()
+    try:
+        assert replayed.statistics(10, 10, 30) == [("emote", 20, 5, 5)]
+    finally:
+        replayed.journal.close()
+        replayed.engine.dispose()
+
+
+def test_history_ranges_before_compaction(tmp_path):
+    """Ranges older than the retention stay exact, ranges before the compacted history are refused"""
+    filename = str(tmp_path / "emotes.db")
+    today = dt.date.today()
+    create_baseline(filename, 100, {today - dt.timedelta(days=45): 10, today - dt.timedelta(days=50): 10})
+
+    manager = sql.Manager(filename, retention_days=30)
+    manager.connect()
+    try:
+        manager.compact_cumulative(manager.history_days)
+        assert manager.statistics(10, 10, 30, date_from=today - dt.timedelta(days=60), date_to=today - dt.timedelta(days=31)) == [
+            ("emote", 20, 100, 20)
+        ]
+    finally:
+        manager.engine.dispose()
+
+    manager = sql.Manager(filename, history_days=40)
+    manager.connect()
+    try:
+        manager.compact_cumulative(manager.history_days)
+        with pytest.raises(ValueError):
+            manager.statistics(10, 10, 30, date_from=today - dt.timedelta(days=60))
+
+        assert manager.statistics(10, 10, 30, date_from=manager.history_start()) == []
+    finally:
+        manager.engine.dispose()
+
+
+def test_split_database(tmp_path):
+    """An unmigrated database is migrated, replayed and split, existing shards are refused"""
+    filename = str(tmp_path / "emotes.db")
+    pattern = str(tmp_path / "emotes_{}.db")
+    today = dt.date.today()
+    create_baseline(filename, 5, {today: 5})
+    log = journal.Journal(f"{filename}.journal")
+    log.open(0)
+    log.append(11, "other", today, [{"name": "other", "snowflake": 21}])
+    log.close()
+
+    sql.split_database(filename, pattern, 2)
+    manager = sql.ShardedManager(pattern, 2)
+    manager.connect()
+    try:
+        assert manager.statistics(10, 10, 30) == [("emote", 20, 5, 5)]
+        assert manager.statistics(11, 10, 30) == [("other", 21, 1, 1)]
+        assert sorted(row[1] for row in manager.global_statistics(10, 30)) == [20, 21]
+    finally:
+        for shard in manager.shards:
+            shard.engine.dispose()
+
+    with pytest.raises(ValueError):
+        sql.split_database(filename, pattern, 2)
+
+
+def test_partitions_published_after_commit(tmp_path):
+    """A new monthly partition is only visible to the readers once the transaction creating it committed"""
+    manager = sql.Manager(str(tmp_path / "emotes.db"), storage="monthly")
+    manager.connect()
+    storage: sql.PartitionedStorage = manager.storage
+    add = storage.add
+    published = []
+
+    def recording_add(connection, emote_id, day, count):
+        add(connection, emote_id, day, count)
+        published.append((day.year, day.month) in storage.partitions)
+        if day.year < 2000:
+            raise sqlite3.OperationalError("disk I/O error")
+
+    storage.add = recording_add
+    try:
+        today = dt.date.today()
+        for day in (dt.date(1999, 1, 1), today):
+            batch = {}
+            manager.aggregate(batch, 10, "guild", day, [{"name": "emote", "snowflake": 20}])
+            try:
+                manager.write_batch(batch)
+            except sqlite3.OperationalError:
+                pass
+
+        assert published == [False, False]
+        assert list(storage.partitions) == [(today.year, today.month)]
+        assert manager.statistics(10, 10, 30) == [("emote", 20, 1, 1)]
+    finally:
+        manager.engine.dispose()